@@ -9,22 +9,103 @@ import msgpack
 from bon import PracticalSecureAggregatorClient
 import numpy as np
 import message_encryption as me
+from transport import get_transport
+from keystore import get_keystore
 import math
+import os
+import struct
+import threading
+import wire
 
 
+# long-polls the controller can also push over a server-sent event stream
+STREAM_PATHS = ["check_aggregate", "get_aggregate", "get_average"]
+
 class TimeoutException(Exception):
   pass
 
+class ChunkSender(threading.Thread):
+  """Streams the initiator's chunks down the chain while the initiator
+  collects the chunks coming back, so that neither end of the chain
+  blocks on a full queue.
+  """
+  def __init__(self, aggregator, aggs, target):
+    threading.Thread.__init__(self, daemon=True)
+    self.aggregator = aggregator
+    self.aggs = aggs
+    self.target = target
+    self.error = None
+
+  def run(self):
+    try:
+      self.aggregator.post_chunks(self.aggs, self.target)
+      self.aggregator.wait_for_repost(self.aggs, self.target)
+    except TimeoutException as e:
+      self.error = e
+
+class Heartbeats(threading.Thread):
+  """Renews the controller leases of all aggregators in this process,
+  with one request per controller and namespace every third of the
+  shortest lease.
+  """
+  def __init__(self):
+    threading.Thread.__init__(self, daemon=True)
+    self.members = {}
+    self.cond = threading.Condition()
+
+  def add(self, aggregator):
+    with self.cond:
+      self.members[id(aggregator)] = aggregator
+      self.cond.notify()
+
+  def remove(self, aggregator):
+    with self.cond:
+      self.members.pop(id(aggregator), None)
+
+  def run(self):
+    while True:
+      with self.cond:
+        while len(self.members) == 0:
+          self.cond.wait()
+        batches = {}
+        for aggregator in self.members.values():
+          batches.setdefault((aggregator.controller, aggregator.namespace), []).append(aggregator)
+        interval = min(aggregator.lease for aggregator in self.members.values()) / 3
+      for members in batches.values():
+        try:
+          members[0].post("heartbeat",{"pub_keys": [aggregator.pem for aggregator in members]})
+        except requests.exceptions.RequestException:
+          # renewed on the next beat, the lease outlasts two missed beats
+          pass
+      time.sleep(interval)
+
+heartbeats = None
+heartbeats_lock = threading.Lock()
+
+def get_heartbeats():
+  global heartbeats
+  with heartbeats_lock:
+    if heartbeats is None:
+      heartbeats = Heartbeats()
+      heartbeats.start()
+    return heartbeats
+
 class SecureAggregation:
   def __init__(self, options={}):
     """Initiates aggregator with options.
 
     Args:
     	options (dict): controller, precision, max_random, poll_time, aggregation_timeout,
-             restart_wait, group, key_size, should_encrypt, ag_type (SAFE,BON,INSEC) 
+             restart_wait, group, key_size, should_encrypt, ag_type (SAFE,BON,INSEC), push,
+             pool_size, retries, retry_backoff, request_timeout, wire_format (json,binary),
+             fixed_point, vector_chunk_size, key_store, key_name, key_pool_size,
+             mask_workers
     """ 
     self.options = options
     self.registrations = None
+    self.laid_out = False
+    self.lease = 0
+    self.pem = None
     if "controller" in self.options:
       self.controller = self.options["controller"]
     else:
@@ -101,8 +182,67 @@ class SecureAggregation:
       self.namespace_password = self.options["namespace_password"]
     else:
       self.namespace_password = ""
+    if "push" in self.options:
+      self.push = self.options["push"]
+    else:
+      self.push = False
+    if "pool_size" in self.options:
+      self.pool_size = self.options["pool_size"]
+    else:
+      self.pool_size = 10
+    if "retries" in self.options:
+      self.retries = self.options["retries"]
+    else:
+      self.retries = 3
+    if "retry_backoff" in self.options:
+      self.retry_backoff = self.options["retry_backoff"]
+    else:
+      self.retry_backoff = 0.1
+    if "request_timeout" in self.options:
+      self.request_timeout = self.options["request_timeout"]
+    else:
+      self.request_timeout = None
+    if "wire_format" in self.options:
+      self.wire_format = self.options["wire_format"]
+    else:
+      self.wire_format = "json"
+    if "fixed_point" in self.options:
+      self.fixed_point = self.options["fixed_point"]
+    else:
+      self.fixed_point = False
+    if "vector_chunk_size" in self.options:
+      self.vector_chunk_size = self.options["vector_chunk_size"]
+    else:
+      self.vector_chunk_size = 0
+    if "key_store" in self.options:
+      self.key_store = self.options["key_store"]
+    else:
+      self.key_store = None
+    if "key_name" in self.options:
+      self.key_name = self.options["key_name"]
+    else:
+      self.key_name = None
+    if "key_pool_size" in self.options:
+      self.key_pool_size = self.options["key_pool_size"]
+    else:
+      self.key_pool_size = 4
+    if "mask_workers" in self.options:
+      self.mask_workers = self.options["mask_workers"]
+    else:
+      self.mask_workers = 1
+    if self.fixed_point:
+      # values scaled by 10^precision in the ring of integers modulo 2^64
+      self.vector_dtype = "<u8"
+    else:
+      self.vector_dtype = "<f8"
+    self.transport = get_transport(self.pool_size, self.retries, self.retry_backoff, self.request_timeout)
 
     self.pubkey = self.privkey = None
+    # parsed peer public keys for the current registrations
+    self.pubkeys = {}
+    # symmetric message keys, RSA-wrapped once per peer and registration epoch
+    self.session_keys = {}
+    self.unwrapped_keys = {}
 
   def debug(self, msg):
     if self.should_debug:
@@ -127,13 +267,26 @@ class SecureAggregation:
     """
     if self.ag_type == "SAFE":
       if self.pubkey is None or self.privkey is None:
-        (self.pubkey, self.privkey) = rsa.newkeys(self.key_size)
-      pem = self.pubkey.save_pkcs1().decode("utf8")
-      data = self.post("register",{"pub_key": pem})
+        if self.key_store is None:
+          (self.pubkey, self.privkey) = rsa.newkeys(self.key_size)
+        else:
+          keystore = get_keystore(self.key_store, self.key_size, self.key_pool_size)
+          (self.pubkey, self.privkey) = keystore.load(self.key_name)
+      self.pem = self.pubkey.save_pkcs1().decode("utf8")
+      self.clear_session_keys()
+      data = self.post("register",{"pub_key": self.pem, "layout": True, "lease": True})
       self.index = data["index"]
+      # the chain the controller laid this node out in, if it lays out chains
+      self.laid_out = "group" in data
+      if self.laid_out:
+        self.group = data["group"]
       self.initiator =  self.index == 1
+      if "lease" in data:
+        # only live nodes are on the chain, heartbeats keep this one live
+        self.lease = data["lease"]
+        get_heartbeats().add(self)
     if self.ag_type == "BON":
-      self.bon = PracticalSecureAggregatorClient(self.real_index)
+      self.bon = PracticalSecureAggregatorClient(self.real_index, self.mask_workers)
       pub = self.bon.get_pubkey()
       data = self.post("register",{"pub_key": pub})
       self.index = data["index"]
@@ -143,17 +296,43 @@ class SecureAggregation:
       data = self.post("register",{"pub_key": random.randint(1,999999999)})
       self.index = data["index"]
 
+  def unregister(self):
+    """
+    Leaves the chains the controller laid this aggregator out in, or
+    ends its lease. The remaining aggregators are rebalanced over the
+    chains before the next aggregation round.
+    """
+    if self.ag_type == "SAFE" and (self.laid_out or self.lease > 0):
+      if self.lease > 0:
+        get_heartbeats().remove(self)
+      self.post("unregister",{"pub_key": self.pem})
+      self.laid_out = False
+      self.lease = 0
+
   def clear_data(self):
     self.post("clear_data",{})
 
+  def get_auth(self):
+    if self.basic_auth:
+      return (self.namespace,self.namespace_password)
+    return None
+
   def post(self, path, val):    
     url = self.controller + "/" + path
     val["group"] = self.group
     val["namespace"] = self.namespace
-    if self.basic_auth:
-      data = requests.post(url, json = val, auth=(self.namespace,self.namespace_password))
+    if self.wire_format == "binary":
+      headers = {"Content-Type": wire.CONTENT_TYPE, "Accept": wire.CONTENT_TYPE}
+      data = self.transport.post(url, data = wire.encode(val), headers = headers, auth=self.get_auth())
+      if data.status_code in [400, 415]:
+        self.debug("Controller does not accept binary frames, falling back to JSON")
+        self.wire_format = "json"
+        return self.post(path, val)
     else:
-      data = requests.post(url, json = val)
+      headers = {"Content-Type": "application/json"}
+      data = self.transport.post(url, data = wire.dumps(val), headers = headers, auth=self.get_auth())
+    if data.headers.get("Content-Type", "").startswith(wire.CONTENT_TYPE):
+      return wire.decode(data.content)
     try:
        j = json.loads(data.text)
     except Exception as e:
@@ -162,31 +341,119 @@ class SecureAggregation:
     return j
 
   def get_random(self, n=1):
-    return [ random.randint(1,self.max_random*10**self.precision)/(10**self.precision) for _ in range(n) ]
+    r = np.frombuffer(os.urandom(8*n), dtype=np.uint64)
+    if self.fixed_point:
+      # uniform ring element, so the mask hides the value completely
+      return r
+    scale = 10**self.precision
+    return (r % np.uint64(self.max_random*scale) + 1)/scale
+
+  def encode(self, value):
+    """Maps a float vector into the aggregation domain. In fixed point mode
+    values are rounded to precision decimals and stored as two's complement
+    integers modulo 2^64, so sums of up to 2^63/10^precision in magnitude
+    are exact and independent of the order of additions.
+    """
+    if not self.fixed_point:
+      return value
+    return np.rint(value*10**self.precision).astype(np.int64).view(np.uint64)
 
   def get_pubkey(self,i):
-    return rsa.PublicKey.load_pkcs1(self.registrations["%d" % i]["pub_key"].encode("utf8")) 
+    if not i in self.pubkeys:
+      self.pubkeys[i] = rsa.PublicKey.load_pkcs1(self.registrations["%d" % i]["pub_key"].encode("utf8"))
+    return self.pubkeys[i]
 
   def to_bytes(self, val):
     return " ".join(map(lambda x: (("%." + ("%d" % self.precision) + "f") % x),val)).encode("utf8")
 
-  def encrypt(self, val, enc_key):
-    if self.should_encrypt:
+  def clear_session_keys(self):
+    self.session_keys = {}
+    self.unwrapped_keys = {}
+
+  def session_key(self, enc_key):
+    """Returns the message key used for a peer and its RSA-wrapped form.
+    The key is made and wrapped on first use and reused until the
+    peer's public key changes, so RSA stays out of the per-hop path.
+    """
+    if not enc_key in self.session_keys:
       message_key = me.gen_key()
-      encrypted_message_key = base64.b64encode(rsa.encrypt(message_key,enc_key)).decode("utf8")
-      encrypted_message = base64.b64encode(me.encrypt(msgpack.packb(val,use_bin_type=True),message_key)).decode("utf8")
+      self.session_keys[enc_key] = (message_key, rsa.encrypt(message_key,enc_key))
+    return self.session_keys[enc_key]
+
+  def unwrap(self, encrypted_message_key):
+    # the wrapped key identifies the session, so each is RSA-decrypted once
+    if not encrypted_message_key in self.unwrapped_keys:
+      self.unwrapped_keys[encrypted_message_key] = rsa.decrypt(encrypted_message_key,self.privkey)
+    return self.unwrapped_keys[encrypted_message_key]
+
+  def associated_data(self, from_node, to_node, chunk=0):
+    # routing fields the controller relays in the clear, authenticated with the aggregate
+    return struct.pack("<QQQQ", self.group, from_node, to_node, chunk)
+
+  def encrypt(self, val, enc_key, to_node, chunk=0):
+    if self.should_encrypt:
+      (message_key, encrypted_message_key) = self.session_key(enc_key)
+      associated_data = self.associated_data(self.index, to_node, chunk)
+      if self.wire_format == "binary":
+        # uint16 LE key length | RSA encrypted message key | encrypted little-endian vector
+        header = struct.pack("<H", len(encrypted_message_key)) + encrypted_message_key
+        return me.encrypt(np.ascontiguousarray(val, dtype=self.vector_dtype),message_key,header,associated_data)
+      encrypted_message_key = base64.b64encode(encrypted_message_key).decode("utf8")
+      encrypted_message = base64.b64encode(me.encrypt(msgpack.packb(val.tolist(),use_bin_type=True),message_key,associated_data=associated_data)).decode("utf8")
       return {'message':encrypted_message,'key':encrypted_message_key}
     else:
       return val
 
-  def decrypt(self, val):
+  def decrypt(self, val, from_node, chunk=0):
     if self.should_encrypt:
-      message_key = rsa.decrypt(base64.b64decode(val['key']),self.privkey)
-      return msgpack.unpackb(me.decrypt(base64.b64decode(val['message']),message_key),raw=False)
+      associated_data = self.associated_data(from_node, self.index, chunk)
+      if isinstance(val, dict):
+        message_key = self.unwrap(base64.b64decode(val['key']))
+        return np.asarray(msgpack.unpackb(me.decrypt(base64.b64decode(val['message']),message_key,associated_data=associated_data),raw=False), dtype=self.vector_dtype)
+      if isinstance(val, str):
+        # binary aggregate relayed as JSON, e.g. pushed over a stream
+        val = base64.b64decode(val)
+      val = memoryview(val)
+      (length,) = struct.unpack_from("<H", val)
+      message_key = self.unwrap(bytes(val[2:2+length]))
+      return np.frombuffer(me.decrypt(val[2+length:],message_key,val[:2+length],associated_data), dtype=self.vector_dtype)
     else:
-      return val
+      return np.asarray(val, dtype=self.vector_dtype)
+
+  def wait_for_push(self, path, val):
+    """
+    Waits for the controller to push the result of a long-poll over a
+    server-sent event stream. Returns None if the controller does not
+    offer streams so the caller can fall back to polling.
+    """
+    url = self.controller + "/stream/" + path
+    val["group"] = self.group
+    val["namespace"] = self.namespace
+    remaining = self.aggregation_timeout - (time.time() - self.aggregation_start)
+    if remaining <= 0:
+      raise TimeoutException
+    try:
+      with self.transport.post(url, json = val, auth=self.get_auth(), stream=True, timeout=remaining) as data:
+        if data.status_code == 404:
+          # the controller has no streams, poll from now on
+          self.debug("Controller does not offer streams, falling back to polling")
+          self.push = False
+        if data.status_code != 200:
+          return None
+        for line in data.iter_lines(decode_unicode=True):
+          if line.startswith("data:"):
+            return json.loads(line[5:])
+          if time.time() - self.aggregation_start > self.aggregation_timeout:
+            raise TimeoutException
+    except requests.exceptions.Timeout:
+      raise TimeoutException
+    return None
 
   def wait_for(self,path,indata={}):
+     if self.push and path in STREAM_PATHS:
+       data = self.wait_for_push(path, dict(indata))
+       if data is not None:
+         return data
      data = self.post(path, indata)
      while data["status"] == "empty":
        if time.time() - self.aggregation_start > self.aggregation_timeout:
@@ -199,16 +466,35 @@ class SecureAggregation:
 
   def wait_for_repost(self, agg, target):
     data = self.wait_for("check_aggregate",{"node":target})
-    if data["status"] == "repost":
-      repost_to = ((data["repost_to"]-1) % self.n)+1 
-      self.debug("Got repost to %d" % repost_to)
-      enc_key = self.get_pubkey(repost_to)
-      enc = self.encrypt(agg, enc_key)
-      self.post("post_aggregate",{"from_node": self.index,"to_node": repost_to, "aggregate": enc})
-      data = self.wait_for_repost(agg, repost_to)
+    while data["status"] == "repost":
+      # the controller names the next node known to be alive
       self.debug("aggregate failed to be consumed for node %d" % target)
-    else:
-      self.debug("aggregate consumed for node %d" % target)
+      target = self.successor(data["repost_to"])
+      self.debug("Got repost to %d" % target)
+      if isinstance(agg, list):
+        self.post_chunks(agg, target)
+      else:
+        enc_key = self.get_pubkey(target)
+        enc = self.encrypt(agg, enc_key, target)
+        self.post("post_aggregate",{"from_node": self.index,"to_node": target, "aggregate": enc})
+      data = self.wait_for("check_aggregate",{"node":target})
+    self.debug("aggregate consumed for node %d" % target)
+
+  def post_chunk(self, agg, chunk, chunks, target, enc_key):
+    """Posts one chunk, waiting while the controller queue for target is full.
+    Returns False if target has been skipped."""
+    data = self.wait_for("post_aggregate",{"from_node": self.index,"to_node": target, "aggregate": self.encrypt(agg, enc_key, target, chunk), "chunk": chunk, "chunks": chunks})
+    return data["status"] != "skipped"
+
+  def post_chunks(self, aggs, target):
+    enc_key = self.get_pubkey(target)
+    for chunk in range(len(aggs)):
+      if not self.post_chunk(aggs[chunk], chunk, len(aggs), target, enc_key):
+        return
+
+  def chunk_slices(self, values):
+    size = self.vector_chunk_size
+    return [slice(start, min(start+size, values)) for start in range(0, values, size)]
 
   def initiate(self):
       data = self.post("should_initiate",{"node": self.index})
@@ -216,61 +502,59 @@ class SecureAggregation:
         self.initiator = True
         self.debug("New initiator")
 
+  def initiate_head(self):
+    # the chain is rebuilt from live nodes every round, its head initiates each round it is head
+    self.initiator = False
+    if self.index == self.successor(1):
+      self.initiate()
+
   def add(self,v1,v2):
-    result = []
-    for i in range(0,len(v1)):
-      result.append(v1[i]+v2[i])
-    return result
+    return np.add(v1,v2)
 
   def subtract(self,v1,v2,d=1):
-    result = []
-    for i in range(0,len(v1)):
-      result.append((v1[i]-v2[i])/d)
-    return result
+    if self.fixed_point:
+      # decode the ring element once, at the end of the chain
+      return np.subtract(v1,v2).view(np.int64)/(10**self.precision)/d
+    return np.subtract(v1,v2)/d
   
   def weighted_aggregate(self, values, weight):
       """Allows computation of weighted aggregates.
 
       Args:
-      	values (float[]): vector of features to be aggregated
+      	values (float[] or numpy.ndarray): vector of features to be aggregated
       	weight (float): weight of this aggregator
 
       Returns:
-      	The weighted average
+      	The weighted average, as a numpy.ndarray if values was one
       """ 
-      aggregates = []
-      aggregates.append(weight)
-      for val in values:
-        aggregates.append(val*weight)
-      result = []
+      weighted = np.asarray(values, dtype=np.float64)
+      aggregates = np.concatenate(([weight], weighted.ravel()*weight))
       averages = self.aggregate(aggregates)
-      for i in range(1,len(averages)):
-        result.append(averages[i]/averages[0])
-      return result
+      result = averages[1:]/averages[0]
+      if isinstance(values, np.ndarray):
+        return result.reshape(values.shape)
+      return result.tolist()
 
   def insec_aggregate(self, v):
     result = self.post("update_model",{"node": self.real_index,"wait_for": self.n, "coef": v})
-    if len(result["coef"]) == 1:
-      return result["coef"][0]
-    return result["coef"]
+    if not "coef" in result:
+      raise TimeoutException
+    return np.asarray(result["coef"], dtype=np.float64)
 
 
   def bon_aggregate(self, v):
     n = len(v)
-    vals = []
-    for val in v:
-      vals.append([val])
-    a = np.array(vals)
+    a = v.reshape(n,1)
     self.bon.set_weights(np.zeros((n,1)) + a, (n,1))
     shared_keys = {}
     for k in self.registrations.keys():
       shared_keys[int(k)] = self.registrations[k]["pub_key"] 
     w = self.bon.set_sharedkeys(shared_keys)
     total = len(shared_keys)
-    result = self.post("post_weights",{"node": self.index, "weights": list(w.flatten())})
+    result = self.post("post_weights",{"node": self.index, "weights": w.flatten()})
     epoch = 0
     if result["post_secret"]:
-      result = self.post("post_secret",{"node": self.index, "secret": [float(x) for x in list(self.bon.get_secret().flatten())]})
+      result = self.post("post_secret",{"node": self.index, "secret": self.bon.get_secret().flatten()})
       epoch = result["epoch"]
     result = self.post("get_weights",{"wait_for": total,"epoch":epoch})
     while result["status"] == "empty":
@@ -278,20 +562,48 @@ class SecureAggregation:
     # nodes failed
     if result["post_reveal_secret"]:
       failed_nodes = result["failed_nodes"]
-      result = self.post("post_reveal_secret",{"node": self.index, "reveal_secret": [float(x) for x in list(self.bon.get_reveal_secret(failed_nodes).flatten())]})
+      result = self.post("post_reveal_secret",{"node": self.index, "reveal_secret": self.bon.get_reveal_secret(failed_nodes).flatten()})
       epoch = result["epoch"]
       result = self.post("get_weights",{"wait_for": total,"epoch":epoch})
       while result["status"] == "empty":
         result = self.post("get_weights",{"wait_for": total,"epoch":epoch})
-    if len(result["weights"]) == 1:
-      return result["weights"][0]
-    return result["weights"]
+    return np.asarray(result["weights"], dtype=np.float64)
 
     
   def refresh_registrations(self):
-    self.registrations = self.post("registrations",{}) 
+    registrations = self.post("registrations",{}) 
+    if not self.registrations is None:
+      # session keys stay valid for peers that kept their public key
+      pub_keys = set(registration["pub_key"] for registration in registrations.values())
+      for (i, registration) in self.registrations.items():
+        if registrations.get(i, {}).get("pub_key") != registration["pub_key"]:
+          enc_key = self.pubkeys.pop(int(i), None)
+          if not enc_key is None and not registration["pub_key"] in pub_keys:
+            self.session_keys.pop(enc_key, None)
+    self.registrations = registrations
     self.n = len(self.registrations) 
 
+  def successor(self, node):
+    """First node on the published chain from node on, wrapping around
+    past the last one. Nodes whose lease lapsed are left out of it.
+    """
+    nodes = sorted(int(i) for i in self.registrations.keys())
+    for i in nodes:
+      if i >= node:
+        return i
+    return nodes[0]
+
+  def sync_layout(self):
+    """Picks up the chain position the controller currently lays this
+    node out in, as the layout changes when nodes register.
+    """
+    data = self.post("register",{"pub_key": self.pem, "layout": True, "lease": True})
+    if data["group"] != self.group or data["index"] != self.index:
+      self.group = data["group"]
+      self.index = data["index"]
+      self.initiator = self.index == 1
+    self.refresh_registrations()
+
   def predicted_wait_average(self):
     if not self.estimate_progress:
       return
@@ -317,57 +629,122 @@ class SecureAggregation:
     when creating the aggregator.
 
     Args:
-    	v (float[]): vector of features to be aggregated
+    	v (float[] or numpy.ndarray): vector of features to be aggregated
 
     Returns:
-    	The average
+    	The average, as a numpy.ndarray of the same shape if v was one
     """ 
-    if not isinstance(v, list):
-      value = [v]
-    else:
-      value = v
-    if self.registrations is None:
+    value = np.asarray(v, dtype=np.float64).ravel()
+    if self.ag_type == "SAFE" and self.laid_out:
+      self.sync_layout()
+    elif self.registrations is None or (self.ag_type == "SAFE" and self.lease > 0):
       self.refresh_registrations() 
+    if self.ag_type == "SAFE" and self.lease > 0:
+      if not "%d" % self.index in self.registrations:
+        # the lease lapsed, renew it and rejoin the chain
+        self.post("heartbeat",{"pub_keys": [self.pem]})
+        self.refresh_registrations()
+      self.initiate_head()
     if self.ag_type == "BON":
-      return self.bon_aggregate(value)
-    if self.ag_type == "INSEC":
-      return self.insec_aggregate(value)
+      avg = self.bon_aggregate(value)
+    elif self.ag_type == "INSEC":
+      avg = self.insec_aggregate(value)
+    else:
+      avg = self.safe_aggregate(value)
+    if isinstance(v, np.ndarray):
+      return avg.reshape(v.shape)
+    if len(value) == 1:
+      return float(avg[0])
+    return avg.tolist()
+
+  def safe_aggregate(self, value):
     values = len(value)
     self.aggregation_start = time.time()
-    self.next = (self.index % self.n)+1 
+    self.next = self.successor(self.index + 1)
     enc_key = self.get_pubkey(self.next)
     try:
-      if self.initiator:
+      if self.vector_chunk_size > 0:
+        avg = self.stream_aggregate(value)
+      elif self.initiator:
         R = self.get_random(values)
-        agg = self.add(R,value)
-        enc = self.encrypt(agg,enc_key)
+        agg = self.add(R,self.encode(value))
+        enc = self.encrypt(agg,enc_key,self.next)
         self.post("post_aggregate",{"from_node": self.index,"to_node": self.next, "aggregate": enc})
         data = self.wait_for_repost(agg, self.next)
         self.predicted_wait_aggregate()
         data = self.wait_for("get_aggregate",{"node": self.index})
-        dec = self.decrypt(data["aggregate"])
+        dec = self.decrypt(data["aggregate"],data["from_node"])
         avg = self.subtract(dec,R,data["posted"])
         self.post("post_average",{"average": avg, "node": self.index})
         self.predicted_wait_average()
         data = self.wait_for("get_average")
-        avg = data["average"]
+        avg = np.asarray(data["average"], dtype=np.float64)
       else:
         self.predicted_wait_aggregate()
         data = self.wait_for("get_aggregate",{"node": self.index})
-        dec = self.decrypt(data["aggregate"])
-        agg = self.add(dec,value)
-        enc = self.encrypt(agg,enc_key)
+        dec = self.decrypt(data["aggregate"],data["from_node"])
+        agg = self.add(dec,self.encode(value))
+        enc = self.encrypt(agg,enc_key,self.next)
         self.debug("posting to node %d" % self.next)
         self.post("post_aggregate",{"from_node": self.index,"to_node": self.next, "aggregate": enc})
         data = self.wait_for_repost(agg, self.next)
         self.predicted_wait_average()
         data = self.wait_for("get_average")
-        avg = data["average"]
+        avg = np.asarray(data["average"], dtype=np.float64)
     except TimeoutException:
       self.debug("Re-initiating aggregation with new initiator...")
       time.sleep(self.restart_wait)
-      self.initiate()
-      return self.aggregate(value)
-    if len(value) == 1:
-      return avg[0]
+      if self.laid_out:
+        # a relayout or a join may have moved this node to another chain
+        self.sync_layout()
+      elif self.lease > 0:
+        self.refresh_registrations()
+      if self.lease > 0:
+        self.initiate_head()
+      else:
+        self.initiate()
+      return self.safe_aggregate(value)
     return avg
+
+  def stream_aggregate(self, value):
+    """SAFE round with the vector split into chunks of vector_chunk_size
+    values. Each chunk is forwarded as soon as it arrives, so the chunks
+    flow down the chain as a pipeline and the controller holds a bounded
+    number of chunks per hop. A chunk 0 arriving mid-stream means the
+    predecessor restarted after a repost, and the stream restarts with it.
+    """
+    slices = self.chunk_slices(len(value))
+    chunks = len(slices)
+    if self.initiator:
+      R = self.get_random(len(value))
+      agg = self.add(R,self.encode(value))
+      sender = ChunkSender(self, [agg[s] for s in slices], self.next)
+      sender.start()
+      self.predicted_wait_aggregate()
+      decs = [None] * chunks
+      received = 0
+      while received < chunks:
+        data = self.wait_for("get_aggregate",{"node": self.index})
+        decs[data["chunk"]] = self.decrypt(data["aggregate"],data["from_node"],data["chunk"])
+        received = data["chunk"] + 1
+      sender.join()
+      if not sender.error is None:
+        raise sender.error
+      avg = self.subtract(np.concatenate(decs),R,data["posted"])
+      self.post("post_average",{"average": avg, "node": self.index})
+    else:
+      self.predicted_wait_aggregate()
+      enc_key = self.get_pubkey(self.next)
+      aggs = [None] * chunks
+      forwarded = 0
+      while forwarded < chunks:
+        data = self.wait_for("get_aggregate",{"node": self.index})
+        chunk = data["chunk"]
+        aggs[chunk] = self.add(self.decrypt(data["aggregate"],data["from_node"],chunk),self.encode(value[slices[chunk]]))
+        self.post_chunk(aggs[chunk], chunk, chunks, self.next, enc_key)
+        forwarded = chunk + 1
+      self.debug("streamed %d chunks to node %d" % (chunks, self.next))
+      self.wait_for_repost(aggs, self.next)
+    self.predicted_wait_average()
+    data = self.wait_for("get_average")
+    return np.asarray(data["average"], dtype=np.float64)
@@ -1,7 +1,8 @@
 #! /usr/bin/python3
 from random import randrange
 import numpy as np
-from copy import deepcopy
+import concurrent.futures
+import threading
 import codecs
 import pickle
 import json
@@ -11,16 +12,53 @@ import sys
 Adapted from https://github.com/ammartahir24/SecureAggregation
 """
 
+# pairwise masks expanded per block of peers, bounding the buffer to MASK_BLOCK x dimensions
+MASK_BLOCK = 64
+# Philox produces 4 values per counter step, ranges start on a step
+PHILOX_WIDTH = 4
+
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(workers):
+	"""Returns the mask thread pool shared by all clients in this process."""
+	with pools_lock:
+		if not workers in pools:
+			pools[workers] = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+		return pools[workers]
+
+def expand(seed,start,out):
+	"""Fills out with values start:start+len(out) of the mask for seed.
+	Each value is the top 24 bits of one Philox draw scaled to [0,1), so
+	any range of the mask can be made without making what precedes it.
+	"""
+	bit_generator = np.random.Philox(key=seed)
+	bit_generator.advance(start//PHILOX_WIDTH)
+	raw = bit_generator.random_raw(len(out))
+	np.multiply(raw >> np.uint64(40),2.0**-24,out=out,casting="unsafe")
+	return out
+
+def mask_sum(seeds,signs,start,out):
+	"""Adds the signed masks for seeds over values start:start+len(out) into out."""
+	for first in range(0,len(seeds),MASK_BLOCK):
+		block = seeds[first:first+MASK_BLOCK]
+		buf = np.empty((len(block),len(out)),dtype=np.float32)
+		for (row,seed) in enumerate(block):
+			expand(seed,start,buf[row])
+		out += signs[first:first+MASK_BLOCK] @ buf
+
 class PracticalSecureAggregator:
 	def __init__(self,common_base,common_mod,dimensions,weights):
 		self.secretkey = randrange(common_mod)
 		self.base = common_base
 		self.mod = common_mod
-		self.pubkey = (self.base**self.secretkey) % self.mod
+		self.pubkey = pow(self.base,self.secretkey,self.mod)
 		self.sndkey = randrange(common_mod)
 		self.dim = dimensions
 		self.weights = weights
 		self.keys = {}
+		self.secrets = {}
+		self.workers = 1
 		self.id = ''
 	def public_key(self):
 		return self.pubkey
@@ -30,39 +68,51 @@ class PracticalSecureAggregator:
 	def configure(self,base,mod):
 		self.base = base
 		self.mod = mod
-		self.pubkey = (self.base**self.secretkey) % self.mod
+		self.pubkey = pow(self.base,self.secretkey,self.mod)
+		self.secrets = {}
+	def shared_secret(self,sid):
+		# agreed once per peer public key
+		pubkey = self.keys[sid]
+		if not sid in self.secrets or self.secrets[sid][0] != pubkey:
+			self.secrets[sid] = (pubkey,pow(pubkey,self.secretkey,self.mod))
+		return self.secrets[sid][1]
 	def generate_weights(self,seed):
-		np.random.seed(seed)
-		return np.float32(np.random.rand(self.dim[0],self.dim[1]))
+		return expand(seed,0,np.empty(int(np.prod(self.dim)),dtype=np.float32)).reshape(self.dim)
+	def masks(self,sids):
+		"""Sum of the pairwise masks shared with sids, added for larger ids
+		and subtracted for smaller ones. With several workers each one
+		reduces its own range of values, seeking every generator to it.
+		"""
+		peers = [sid for sid in sids if sid != self.id]
+		seeds = [self.shared_secret(sid) for sid in peers]
+		signs = np.array([1.0 if sid>self.id else -1.0 for sid in peers])
+		total = np.zeros(int(np.prod(self.dim)))
+		step = -(-len(total)//self.workers)
+		step += -step % PHILOX_WIDTH
+		if self.workers <= 1 or step >= len(total):
+			mask_sum(seeds,signs,0,total)
+		else:
+			pool = get_pool(self.workers)
+			futures = [pool.submit(mask_sum,seeds,signs,start,total[start:start+step]) for start in range(0,len(total),step)]
+			for future in futures:
+				future.result()
+		return total.reshape(self.dim)
 	def prepare_weights(self,shared_keys,myid):
 		self.keys = shared_keys
 		self.id = myid
-		wghts = deepcopy(self.weights)
-		for sid in shared_keys:
-			if sid>myid:
-				#print ("1",myid,sid,(shared_keys[sid]**self.secretkey)%self.mod)
-				wghts+=self.generate_weights((shared_keys[sid]**self.secretkey)%self.mod)
-			elif sid<myid:
-				#print ("2",myid,sid,(shared_keys[sid]**self.secretkey)%self.mod)
-				wghts-=self.generate_weights((shared_keys[sid]**self.secretkey)%self.mod)
+		wghts = self.weights + self.masks(shared_keys)
 		wghts+=self.generate_weights(self.sndkey)
 		return wghts
 	def reveal(self, keylist):
-		wghts = np.zeros(self.dim)
-		for each in keylist:
-			#print(each)
-			if each<self.id:
-				wghts-=self.generate_weights((self.keys[each]**self.secretkey)%self.mod)
-			elif each>self.id:
-				wghts+=self.generate_weights((self.keys[each]**self.secretkey)%self.mod)
-		return -1*wghts
+		return -1*self.masks(keylist)
 	def private_secret(self):
 		return self.generate_weights(self.sndkey)
 
 
 class PracticalSecureAggregatorClient:
-	def __init__(self, node_id):
+	def __init__(self, node_id, workers=1):
 		self.aggregator = PracticalSecureAggregator(3,100103,(10,1),np.float32(np.full((10,1),3,dtype=int)))
+		self.aggregator.workers = workers
 		self.id = node_id
 		self.keys = {}
                 
@@ -41,3 +41,4 @@ while agg != "":
     valout = "%.5f" % val
   print("Average: %s" % valout)
   agg = input("Aggregate: ") 
+s.unregister()
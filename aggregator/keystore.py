@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+import concurrent.futures
+import os
+import threading
+import uuid
+import rsa
+
+keystores = {}
+keystores_lock = threading.Lock()
+
+
+def generate(key_size):
+  (_, privkey) = rsa.newkeys(key_size)
+  return privkey.save_pkcs1()
+
+def parse(pem):
+  privkey = rsa.PrivateKey.load_pkcs1(pem)
+  return (rsa.PublicKey(privkey.n, privkey.e), privkey)
+
+def write(path, pem):
+  tmp = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+  with open(tmp, "wb") as f:
+    f.write(pem)
+  os.replace(tmp, path)
+
+
+class KeyStore:
+  """RSA keys persisted as PEM files in a directory.
+
+  Named keys are kept in <path>/<name>.pem so a restarted aggregator
+  registers with the same key. A pool of unused keys of each key size is
+  kept in <path>/pool/<key_size>/ and refilled by a background process
+  pool, so taking a key rarely waits for key generation.
+  """
+  def __init__(self, path, key_size=1024, pool_size=4):
+    self.path = path
+    self.key_size = key_size
+    self.pool_size = pool_size
+    self.pool_path = os.path.join(path, "pool", "%d" % key_size)
+    os.makedirs(self.pool_path, exist_ok=True)
+    self.lock = threading.Lock()
+    self.pending = []
+    self.executor = None
+    self.refill()
+
+  def load(self, name=None):
+    """Returns (pubkey, privkey), the persisted key called name if there
+    is one, otherwise a pooled key which is persisted under name if set.
+    """
+    if not name is None:
+      key_path = os.path.join(self.path, "%s.pem" % name)
+      if os.path.exists(key_path):
+        with open(key_path, "rb") as f:
+          return parse(f.read())
+    pem = self.take()
+    if not name is None:
+      write(key_path, pem)
+    self.refill()
+    return parse(pem)
+
+  def take(self):
+    for filename in sorted(os.listdir(self.pool_path)):
+      if not filename.endswith(".pem"):
+        continue
+      pooled = os.path.join(self.pool_path, filename)
+      claimed = "%s.%s.claimed" % (pooled, uuid.uuid4().hex)
+      try:
+        # the rename is atomic, so a key is handed out once across processes
+        os.rename(pooled, claimed)
+      except FileNotFoundError:
+        continue
+      with open(claimed, "rb") as f:
+        pem = f.read()
+      os.remove(claimed)
+      return pem
+    with self.lock:
+      future = self.pending.pop(0) if len(self.pending) > 0 else None
+    if not future is None:
+      return future.result()
+    return generate(self.key_size)
+
+  def refill(self):
+    with self.lock:
+      pooled = len([f for f in os.listdir(self.pool_path) if f.endswith(".pem")])
+      missing = self.pool_size - pooled - len(self.pending)
+      if missing <= 0:
+        return
+      if self.executor is None:
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(self.pool_size, os.cpu_count() or 1))
+      for _ in range(missing):
+        future = self.executor.submit(generate, self.key_size)
+        self.pending.append(future)
+        future.add_done_callback(self.store)
+
+  def store(self, future):
+    with self.lock:
+      if not future in self.pending:
+        # already handed out by take
+        return
+      self.pending.remove(future)
+    if future.cancelled() or not future.exception() is None:
+      return
+    write(os.path.join(self.pool_path, "%s.pem" % uuid.uuid4().hex), future.result())
+
+
+def get_keystore(path, key_size=1024, pool_size=4):
+  """Returns the keystore shared by all aggregators in this process
+  that use the same directory and key size.
+  """
+  key = (os.path.abspath(path), key_size)
+  with keystores_lock:
+    if key not in keystores:
+      keystores[key] = KeyStore(path, key_size, pool_size)
+    return keystores[key]
@@ -1,19 +1,48 @@
 #! /usr/bin/env python3
 from Crypto.Cipher import AES
-import base64, os
+import os
+
+# AES-256-GCM over raw bytes. A message is
+#
+#   header | 12 byte nonce | ciphertext | 16 byte tag
+#
+# where header is an optional cleartext prefix chosen by the caller. The
+# header and any associated data, e.g. routing fields sent alongside the
+# message, are authenticated by the tag. The ciphertext is written straight
+# into the output buffer, so a payload is copied once on encryption and
+# once on decryption.
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
 
 def gen_key():
   return os.urandom(32)
 
-def encrypt(msg, secret_key, padding_character="^"):
-  private_msg = base64.b64encode(msg).decode("utf-8")
-  cipher = AES.new(secret_key)
-  padded_private_msg = private_msg + (padding_character * ((16-len(private_msg)) % 16))
-  return cipher.encrypt(padded_private_msg)
-
-def decrypt(encrypted_msg, secret_key, padding_character="^"):
-  cipher = AES.new(secret_key)
-  decrypted_msg = cipher.decrypt(encrypted_msg)
-  unpadded_private_msg = decrypted_msg.decode("utf8").rstrip(padding_character)
-  return base64.b64decode(unpadded_private_msg)
+def encrypt(msg, secret_key, header=b"", associated_data=b""):
+  msg = memoryview(msg).cast("B")
+  nonce = os.urandom(NONCE_SIZE)
+  start = len(header) + NONCE_SIZE
+  out = bytearray(start + len(msg) + TAG_SIZE)
+  view = memoryview(out)
+  view[:len(header)] = header
+  view[len(header):start] = nonce
+  cipher = AES.new(secret_key, AES.MODE_GCM, nonce=nonce)
+  cipher.update(bytes(header) + associated_data)
+  cipher.encrypt(msg, output=view[start:start+len(msg)])
+  view[start+len(msg):] = cipher.digest()
+  return out
 
+def decrypt(encrypted_msg, secret_key, header=b"", associated_data=b""):
+  """Decrypts a message without its header, given the header and associated
+  data it was encrypted with. Raises ValueError if the message, header or
+  associated data was tampered with or encrypted under another key.
+  """
+  view = memoryview(encrypted_msg).cast("B")
+  if len(view) < NONCE_SIZE + TAG_SIZE:
+    raise ValueError("Encrypted message too short")
+  cipher = AES.new(secret_key, AES.MODE_GCM, nonce=view[:NONCE_SIZE])
+  cipher.update(bytes(header) + associated_data)
+  out = bytearray(len(view) - NONCE_SIZE - TAG_SIZE)
+  cipher.decrypt(view[NONCE_SIZE:len(view)-TAG_SIZE], output=out)
+  cipher.verify(view[len(view)-TAG_SIZE:])
+  return out
@@ -0,0 +1,44 @@
+#! /usr/bin/env python3
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+transports = {}
+transports_lock = threading.Lock()
+
+
+class Transport:
+  """Keep-alive HTTP connection pool to the controller.
+
+  Connection errors are retried with exponential backoff, since the
+  request never reached the controller. Posts such as post_aggregate are
+  not idempotent, so read errors and 502/503/504 answers, which may
+  follow a request the controller already applied, are only retried
+  for idempotent methods.
+  """
+  def __init__(self, pool_size=10, retries=3, backoff=0.1, timeout=None):
+    retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                  backoff_factor=backoff, status_forcelist=[502, 503, 504],
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    self.session = requests.Session()
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+    self.timeout = timeout
+
+  def post(self, url, **kwargs):
+    if "timeout" not in kwargs:
+      kwargs["timeout"] = self.timeout
+    return self.session.post(url, **kwargs)
+
+
+def get_transport(pool_size=10, retries=3, backoff=0.1, timeout=None):
+  """Returns the transport shared by all aggregators in this process
+  that use the same pool settings.
+  """
+  key = (pool_size, retries, backoff, timeout)
+  with transports_lock:
+    if key not in transports:
+      transports[key] = Transport(pool_size, retries, backoff, timeout)
+    return transports[key]
@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+import base64
+import json
+import struct
+import numpy as np
+
+# Binary wire format for vector-carrying requests and responses, kept in
+# sync with server/wire.py. A frame is the magic, the length of a JSON
+# header, the JSON header and the raw blobs the header points into:
+#
+#   b"SAFE" | uint32 LE header length | header | blob 0 | blob 1 ...
+#
+# Vectors are stored as raw little-endian arrays and opaque payloads such as
+# encrypted aggregates as plain bytes, each replaced in the header by
+# {"$blob": [offset, length, dtype, shape]} with dtype "bytes" for the latter.
+
+CONTENT_TYPE = "application/x-safe-frame"
+MAGIC = b"SAFE"
+VECTOR_FIELDS = ("aggregate", "average", "coef", "weights", "secret", "reveal_secret")
+
+
+def to_json(value):
+  if isinstance(value, np.ndarray):
+    return value.tolist()
+  if isinstance(value, np.generic):
+    return value.item()
+  if isinstance(value, (bytes, bytearray, memoryview)):
+    return base64.b64encode(value).decode("utf8")
+  raise TypeError("%s is not JSON serializable" % type(value).__name__)
+
+def dumps(data):
+  return json.dumps(data, default=to_json)
+
+def accepts(header):
+  return not header is None and CONTENT_TYPE in header
+
+def encode(data):
+  header = {}
+  blobs = []
+  offset = 0
+  for (key, value) in data.items():
+    if key in VECTOR_FIELDS and isinstance(value, list):
+      value = np.asarray(value, dtype=np.float64)
+    if isinstance(value, np.ndarray):
+      shape = list(value.shape)
+      value = np.ascontiguousarray(value, dtype=value.dtype.newbyteorder("<"))
+      blob = memoryview(value.reshape(-1)).cast("B")
+      header[key] = {"$blob": [offset, len(blob), value.dtype.str, shape]}
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+      blob = memoryview(value).cast("B")
+      header[key] = {"$blob": [offset, len(blob), "bytes", [len(blob)]]}
+    else:
+      header[key] = value
+      continue
+    blobs.append(blob)
+    offset += len(blob)
+  head = dumps(header).encode("utf8")
+  return b"".join([MAGIC, struct.pack("<I", len(head)), head] + blobs)
+
+def decode(body):
+  """Decodes a frame without copying its blobs. Vectors are returned as
+  read-only numpy arrays and opaque payloads as memoryviews of body.
+  """
+  view = memoryview(body)
+  if bytes(view[:4]) != MAGIC:
+    raise ValueError("not a SAFE frame")
+  (length,) = struct.unpack_from("<I", view, 4)
+  data = json.loads(bytes(view[8:8+length]))
+  blobs = view[8+length:]
+  for (key, value) in data.items():
+    if isinstance(value, dict) and "$blob" in value:
+      (offset, size, dtype, shape) = value["$blob"]
+      blob = blobs[offset:offset+size]
+      if dtype == "bytes":
+        data[key] = blob
+      else:
+        data[key] = np.frombuffer(blob, dtype=dtype).reshape(shape)
+  return data
+
+def strip(data):
+  """The echo of a posted frame, without its vectors."""
+  return {key: value for (key, value) in data.items() if not key in VECTOR_FIELDS}
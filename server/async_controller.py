@@ -0,0 +1,214 @@
+#! /usr/bin/env python3
+from aiohttp import web
+import aiohttp
+import asyncio
+import sys
+import os
+
+from insec import InSec
+from safe import Safe
+from bons import Bon
+from service import auth_enabled, check_password, get_instance_namespace, get_ns, get_group, remove_namespace
+from store import get_store
+from waiters import is_empty
+from prebuilt import dumps, pack
+import wire
+
+# Serves the same JSON API as controller.py from a single event loop. Long
+# polls are parked as coroutines on the same waiters the threaded controller
+# blocks on, so an idle client costs a future instead of a thread. Calls
+# into a shared state store run in the executor, off the event loop.
+
+controller_workers_env = os.getenv("CONTROLLER_WORKERS")
+if controller_workers_env is None or controller_workers_env == "":
+  controller_workers = 1
+else:
+  controller_workers = int(controller_workers_env)
+
+store = get_store()
+
+print(f"Auth Enabled {auth_enabled}")
+
+def unauthorized():
+  return web.HTTPUnauthorized(headers={"WWW-Authenticate": 'Basic realm="Authentication Required"'})
+
+def check_user(request, namespace):
+  if not auth_enabled:
+    return
+  header = request.headers.get("Authorization")
+  if header is None:
+    raise unauthorized()
+  try:
+    credentials = aiohttp.BasicAuth.decode(header)
+  except ValueError:
+    raise unauthorized()
+  if credentials.login != namespace or not check_password(credentials.login, credentials.password):
+    raise unauthorized()
+
+def get_instance(request, data, algo, constructor):
+  namespace = get_ns(data)
+  check_user(request, namespace)
+  return get_instance_namespace(namespace, algo, constructor)
+
+def get_insec(request, data):
+  return get_instance(request, data, "insec", InSec)
+
+def get_bon(request, data):
+  return get_instance(request, data, "bon", Bon)
+
+def get_safe(request, data):
+  return get_instance(request, data, "safe", Safe)
+
+async def call(func, *args):
+  # a shared store does I/O under its locks, which stays off the event loop
+  if store.poll_interval is None:
+    return func(*args)
+  return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+async def get_data(request):
+  if request.content_type == wire.CONTENT_TYPE:
+    return wire.decode(await request.read())
+  return await request.json()
+
+def respond(request, result):
+  if wire.accepts(request.headers.get("Accept")):
+    return web.Response(body=pack(result), content_type=wire.CONTENT_TYPE)
+  return web.Response(text=dumps(result), content_type="application/json")
+
+def echo(request, data):
+  if request.content_type == wire.CONTENT_TYPE:
+    return wire.strip(data)
+  return data
+
+async def update_model(request, data):
+  return await get_insec(request, data).aupdate_model(data["node"], data["coef"], data["wait_for"])
+
+async def init_weights(request, data):
+  return await call(get_bon(request, data).init_weights, data["node"])
+
+async def post_weights(request, data):
+  return await call(get_bon(request, data).post_weights, data["node"], data["weights"])
+
+async def post_secret(request, data):
+  return await call(get_bon(request, data).post_secret, data["node"], data["secret"])
+
+async def post_reveal_secret(request, data):
+  return await call(get_bon(request, data).post_reveal_secret, data["node"], data["reveal_secret"])
+
+async def get_weights(request, data):
+  return await get_bon(request, data).aget_weights(data["wait_for"], data["epoch"])
+
+async def should_initiate(request, data):
+  return await call(get_safe(request, data).should_initiate, data["node"], get_group(data))
+
+async def post_aggregate(request, data):
+  if "chunk" in data:
+    return await get_safe(request, data).apost_chunk(data["from_node"], data["to_node"], data["aggregate"], data["chunk"], data["chunks"], get_group(data))
+  await call(get_safe(request, data).post_aggregate, data["from_node"], data["to_node"], data["aggregate"], get_group(data))
+  return echo(request, data)
+
+async def check_aggregate(request, data):
+  return await get_safe(request, data).acheck_aggregate(data["node"], get_group(data))
+
+async def get_aggregate(request, data):
+  return await get_safe(request, data).aget_aggregate(data["node"], get_group(data))
+
+async def post_average(request, data):
+  node = None
+  if "node" in data:
+    node = data["node"]
+  await call(get_safe(request, data).post_average, node, data["average"], get_group(data))
+  return echo(request, data)
+
+async def get_average(request, data):
+  node = None
+  if "node" in data:
+    node = data["node"]
+  return await get_safe(request, data).aget_average(node)
+
+async def register(request, data):
+  return await call(get_safe(request, data).register, data["pub_key"], get_group(data), data.get("layout", False), data.get("lease", False))
+
+async def heartbeat(request, data):
+  return await call(get_safe(request, data).heartbeat, data["pub_keys"])
+
+async def unregister(request, data):
+  return await call(get_safe(request, data).unregister, data["pub_key"])
+
+async def get_registrations(request, data):
+  return await call(get_safe(request, data).get_registrations, get_group(data))
+
+async def clear_data(request, data):
+  await call(get_safe(request, data).clear_data)
+  await call(get_bon(request, data).clear_data)
+  await call(get_insec(request, data).clear_data)
+  return {"status":"OK"}
+
+async def delete_namespace(request, data):
+  check_user(request, get_ns(data))
+  await call(remove_namespace, get_ns(data))
+  return {"status":"OK"}
+
+routes = {
+  "update_model": update_model,
+  "init_weights": init_weights,
+  "post_weights": post_weights,
+  "post_secret": post_secret,
+  "post_reveal_secret": post_reveal_secret,
+  "get_weights": get_weights,
+  "should_initiate": should_initiate,
+  "post_aggregate": post_aggregate,
+  "check_aggregate": check_aggregate,
+  "get_aggregate": get_aggregate,
+  "post_average": post_average,
+  "get_average": get_average,
+  "register": register,
+  "unregister": unregister,
+  "heartbeat": heartbeat,
+  "registrations": get_registrations,
+  "clear_data": clear_data,
+  "delete_namespace": delete_namespace,
+}
+
+# long-polls that may also be consumed as a server-sent event stream
+stream_routes = ["check_aggregate", "get_aggregate", "get_average", "get_weights"]
+
+async def post_op(request):
+  path = request.match_info["path"]
+  if path not in routes:
+    raise web.HTTPNotFound()
+  data = await get_data(request)
+  result = await routes[path](request, data)
+  return respond(request, result)
+
+async def stream_op(request):
+  """Holds the request open and pushes the result as a single
+  server-sent event as soon as it is available, with keepalive
+  comments every poll interval, so clients do not re-post.
+  """
+  path = request.match_info["path"]
+  if path not in stream_routes:
+    raise web.HTTPNotFound()
+  data = await get_data(request)
+  check_user(request, get_ns(data))
+  response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+  await response.prepare(request)
+  result = await routes[path](request, data)
+  while is_empty(result):
+    await response.write(b": keepalive\n\n")
+    result = await routes[path](request, data)
+  await response.write(("event: %s\ndata: %s\n\n" % (path, dumps(result))).encode("utf8"))
+  await response.write_eof()
+  return response
+
+app = web.Application()
+app.router.add_post('/stream/{path}', stream_op)
+app.router.add_post('/{path}', post_op)
+
+
+if __name__ == "__main__":
+    port = 8088
+    if len(sys.argv) > 1:
+       port = int(sys.argv[1])
+    # several worker processes share the port, and their state through STATE_STORE
+    web.run_app(app, host="0.0.0.0", port=port, reuse_port=controller_workers > 1)
@@ -1,12 +1,49 @@
 #! /usr/bin/env python3
 import time
 import os
-import threading
 import numpy as np
+from prebuilt import Prebuilt
+from store import get_store
+from waiters import Waiters, is_empty
 
-class Bon:
+# epochs kept after a newer one starts, for clients still collecting them
+KEPT_EPOCHS = 3
+
+
+class BonEpoch:
+  """Running sum of one epoch. Each vector is parsed once and folded in
+  as it is posted, and the finished result is built once for all clients.
+  """
   def __init__(self):
+    self.total = None
+    self.contributed = set()
+    self.revealed = set()
+    self.result = None
+
+  def add(self, vector):
+    if self.total is None:
+      self.total = np.zeros(len(vector))
+    self.total += vector
+    self.result = None
+
+  def get_result(self):
+    if self.result is None:
+      self.result = Prebuilt({"status": "OK","post_reveal_secret": False, "weights": self.total.copy()})
+    return self.result
+
+  def __getstate__(self):
+    # the shared response is rebuilt on demand after a reload
+    state = dict(self.__dict__)
+    state["result"] = None
+    return state
+
+
+class Bon:
+  def __init__(self, namespace="global"):
+    self.key = "%s/bon" % namespace
+    self.store = get_store()
     self.nodes = {}
+    self.epochs = {}
     progress_timeout_env = os.getenv("PROGRESS_TIMEOUT")
     if progress_timeout_env is None or progress_timeout_env == "":
       progress_timeout = 60
@@ -19,7 +56,8 @@ class Bon:
       self.should_debug = False
     else:
       self.should_debug = (should_debug_env == "yes")
-    self.lock = threading.Semaphore()
+    self.lock = self.store.lock(self, self.key)
+    self.waiters = Waiters(self.lock, self.store.poll_interval)
 
   def debug(self, msg):
     if not self.should_debug:
@@ -27,37 +65,33 @@ class Bon:
     with open("controller.debug",'a') as f:
       f.write("BON DEBUG [%.3f] %s\n" % (time.time(),msg))
 
-  def get_secure_posted(self, epoch):
-    posted = 0
-    reveal_posted = 0
-    with self.lock:
-      for n in self.nodes.keys():
-        if self.nodes[n]["epoch"] == epoch and self.nodes[n]["secret_epoch"] == epoch:
-          posted += 1
-        if self.nodes[n]["epoch"] == epoch and self.nodes[n]["reveal_secret_epoch"] == epoch:
-          reveal_posted += 1
-    return (posted,reveal_posted)
+  def get_state(self):
+    return {"nodes": self.nodes, "epochs": self.epochs}
+
+  def set_state(self, state):
+    self.__dict__.update(state)
+
+  def get_epoch(self, epoch):
+    # caller holds self.lock
+    if not epoch in self.epochs:
+      self.epochs[epoch] = BonEpoch()
+      for old in [e for e in self.epochs.keys() if e <= epoch - KEPT_EPOCHS]:
+        del self.epochs[old]
+    return self.epochs[epoch]
 
   def get_failed_nodes(self, epoch):
-    failed_nodes = []
     with self.lock:
-      for n in self.nodes.keys():
-        if self.nodes[n]["epoch"] != epoch or self.nodes[n]["secret_epoch"] != epoch:
-          failed_nodes.append(n)
-    return failed_nodes
-
-  def wait_for_secure(self, total_nodes, epoch):
-    start_time = time.time()
-    (posted, reveal_posted) = self.get_secure_posted(epoch)
-    while posted < total_nodes and (time.time() - start_time) < self.config["progress_timeout"]:
-      (posted, reveal_posted) = self.get_secure_posted(epoch)
-      failed_nodes = total_nodes - posted
-      # for now only handle a single failure at a time
-      if reveal_posted == (total_nodes - failed_nodes):
-        posted = total_nodes
-        break
-      time.sleep(0.01)
-    return {"ok": posted >= total_nodes,"timeout":  (time.time() - start_time) >= self.config["progress_timeout"]}
+      state = self.get_epoch(epoch)
+      return [n for n in self.nodes.keys() if not n in state.contributed]
+
+  def internal_get_weights(self, params):
+    state = self.get_epoch(params["epoch"])
+    posted = len(state.contributed)
+    # complete when all nodes posted, or when every node that did has
+    # revealed the masks of the failed ones
+    if posted >= params["total_nodes"] or (posted > 0 and len(state.revealed) == posted):
+      return state.get_result()
+    return {"status": "empty"}
 
   def init_weights(self, node):
     with self.lock:
@@ -69,44 +103,53 @@ class Bon:
     with self.lock:
       if node not in self.nodes:
          self.nodes[node] = {"epoch": 0, "secret_epoch": 0, "reveal_secret_epoch": 0}
-      self.nodes[node]["weights"] = weights
+      self.nodes[node]["weights"] = np.asarray(weights, dtype=np.float64).ravel()
       self.nodes[node]["epoch"] += 1
     return {"post_secret": True}
 
   def post_secret(self, node, secret):
     with self.lock:
-      self.nodes[node]["secret"] = secret
       self.nodes[node]["secret_epoch"] += 1
+      epoch = self.nodes[node]["epoch"]
+      if self.nodes[node]["secret_epoch"] == epoch:
+        state = self.get_epoch(epoch)
+        if not node in state.contributed:
+          state.contributed.add(node)
+          state.add(self.nodes[node]["weights"] + np.asarray(secret, dtype=np.float64).ravel())
+          self.waiters.notify(("epoch", epoch))
     return {"status": "OK","epoch": self.nodes[node]["epoch"]}
 
   def post_reveal_secret(self, node, reveal_secret):
     with self.lock:
-      self.nodes[node]["reveal_secret"] = reveal_secret
       self.nodes[node]["reveal_secret_epoch"] += 1
+      epoch = self.nodes[node]["epoch"]
+      if self.nodes[node]["reveal_secret_epoch"] == epoch:
+        state = self.get_epoch(epoch)
+        if not node in state.revealed:
+          state.revealed.add(node)
+          if node in state.contributed:
+            state.add(np.asarray(reveal_secret, dtype=np.float64).ravel())
+          self.waiters.notify(("epoch", epoch))
     return {"status": "OK","epoch": self.nodes[node]["epoch"]}
 
   def get_weights(self, total_nodes, epoch):
-    is_ok = self.wait_for_secure(total_nodes,epoch)
-    if is_ok["timeout"]:
+    result = self.waiters.poll(self.internal_get_weights, {"total_nodes": total_nodes, "epoch": epoch}, ("epoch", epoch), self.config["progress_timeout"])
+    return self.weights_result(result, epoch)
+
+  async def aget_weights(self, total_nodes, epoch):
+    result = await self.waiters.apoll(self.internal_get_weights, {"total_nodes": total_nodes, "epoch": epoch}, ("epoch", epoch), self.config["progress_timeout"])
+    return self.weights_result(result, epoch)
+
+  def weights_result(self, result, epoch):
+    if is_empty(result):
       failed_nodes = self.get_failed_nodes(epoch)
       return {"status": "failure", "post_reveal_secret": True, "failed_nodes": failed_nodes}
-    if not is_ok["ok"]:
-      return {"status": "empty"}
-    with self.lock:
-      n = len(list(self.nodes.values())[0]["weights"])
-      agg =  np.zeros((n,1))
-      for node in self.nodes.values():
-        if node["epoch"] == epoch and node["secret_epoch"] == epoch:
-          self.debug("weights: %s" % (node["weights"]))
-          self.debug("secret: %s" % (node["secret"]))
-          agg += np.array(node["weights"]).reshape(n,1)
-          agg += np.array(node["secret"]).reshape(n,1)
-          if node["reveal_secret_epoch"] == epoch:
-            self.debug("reveal secret: %s" % (node["reveal_secret"]))
-            agg += np.array(node["reveal_secret"]).reshape(n,1)
-    return {"status": "OK","post_reveal_secret": False, "weights": list(agg.flatten())}
+    return result
 
   def clear_data(self):
     with self.lock:
       self.nodes = {}
-      return {"status":"OK"}
+      self.epochs = {}
+      self.waiters.notify_all()
+    self.store.remove(self.key)
+    return {"status":"OK"}
@@ -1,16 +1,16 @@
 #! /usr/bin/env python3
 from flask import Flask, request, jsonify, Response, abort
 from flask_httpauth import HTTPBasicAuth
-from werkzeug.security import check_password_hash
 from flasgger import Swagger
 from functools import wraps
-import json
 import sys
-import os
 
 from insec import InSec
 from safe import Safe
 from bons import Bon
+from service import auth_enabled, check_password, get_instance_namespace, get_ns, remove_namespace
+from prebuilt import dumps, pack
+import wire
 
 
 app = Flask(__name__)
@@ -22,25 +22,11 @@ swagger = Swagger(app,template_file='swagger.yaml')
 
 auth = HTTPBasicAuth()
 
-ns = {} 
-
-namespace_auth_db = {}
-filename = '/config/namespaces.json'
-if os.path.exists(filename):
-  with open(filename) as f: 
-    namespace_auth_db = json.loads(f.read())
-
-auth_enabled_env = os.getenv("AUTH_ENABLED")
-auth_enabled = False
-if not auth_enabled_env is None and auth_enabled_env == "yes":
-  auth_enabled = True
-
 print(f"Auth Enabled {auth_enabled}")
 
 @auth.verify_password
 def verify_password(namespace, password):
-  if namespace in namespace_auth_db and \
-            check_password_hash(namespace_auth_db.get(namespace), password):
+  if check_password(namespace, password):
         return namespace
 
 @auth.login_required
@@ -49,16 +35,22 @@ def check_user(user):
   if auth_user != user:
     abort(401)
 
-def get_instance_namespace(namespace, algo, constructor):
-  global ns
-  if namespace not in ns:
-    ns[namespace] = {}
-  if algo not in ns[namespace]:
-    ns[namespace][algo] = constructor()
-  return ns[namespace][algo]
+def get_data():
+  if request.mimetype == wire.CONTENT_TYPE:
+    return wire.decode(request.get_data())
+  return request.get_json(force=True)
+
+def respond(result):
+  if wire.accepts(request.headers.get("Accept")):
+    return Response(pack(result), mimetype=wire.CONTENT_TYPE)
+  return dumps(result)
+
+def echo(data):
+  if request.mimetype == wire.CONTENT_TYPE:
+    return respond(wire.strip(data))
+  return dumps(data)
 
 def get_instance(namespace, algo, constructor):
-  global auth_enabled
   if auth_enabled:
     response = check_user(namespace)
     if isinstance(response, Response):
@@ -74,11 +66,6 @@ def get_bon(namespace="global"):
 def get_safe(namespace="global"):
   return get_instance(namespace, "safe", Safe)
 
-def get_ns(data):
-  if "namespace" in data:
-    return data["namespace"]
-  return "global"
-
 @app.route('/update_model',methods=['POST'])
 def update_model():
     """Allows a set of nodes to average coefficients.
@@ -111,11 +98,11 @@ def update_model():
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     total_nodes = data["wait_for"]
     node = data["node"]
     coef = data["coef"]
-    return json.dumps(get_insec(get_ns(data)).update_model(node, coef, total_nodes))
+    return respond(get_insec(get_ns(data)).update_model(node, coef, total_nodes))
 
 @app.route('/init_weights',methods=['POST'])
 def init_weights():
@@ -140,9 +127,9 @@ def init_weights():
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     node = data["node"]
-    return json.dumps(get_bon(get_ns(data)).init_weights(node))
+    return respond(get_bon(get_ns(data)).init_weights(node))
 
 @app.route('/post_weights',methods=['POST'])
 def post_weights():
@@ -173,10 +160,10 @@ def post_weights():
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     node = data["node"]
     weights = data["weights"]
-    return json.dumps(get_bon(get_ns(data)).post_weights(node, weights))
+    return respond(get_bon(get_ns(data)).post_weights(node, weights))
 
 @app.route('/post_secret',methods=['POST'])
 def post_secret():
@@ -207,10 +194,10 @@ def post_secret():
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     node = data["node"]
     secret = data["secret"]
-    return json.dumps(get_bon(get_ns(data)).post_secret(node, secret))
+    return respond(get_bon(get_ns(data)).post_secret(node, secret))
 
 @app.route('/post_reveal_secret',methods=['POST'])
 def post_reveal_secret():
@@ -241,10 +228,10 @@ def post_reveal_secret():
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     node = data["node"]
     reveal_secret = data["reveal_secret"]
-    return json.dumps(get_bon(get_ns(data)).post_reveal_secret(node, reveal_secret))
+    return respond(get_bon(get_ns(data)).post_reveal_secret(node, reveal_secret))
 
 @app.route('/get_weights',methods=['POST'])
 def get_weights():
@@ -272,10 +259,10 @@ def get_weights():
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     total_nodes = data["wait_for"]
     epoch = data["epoch"]
-    return json.dumps(get_bon(get_ns(data)).get_weights(total_nodes, epoch))
+    return respond(get_bon(get_ns(data)).get_weights(total_nodes, epoch))
 
 @app.route('/should_initiate',methods=['POST'])
 def should_initiate():
@@ -303,12 +290,12 @@ def should_initiate():
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     node = data["node"]
     group = 1
     if "group" in data:
       group = data["group"]
-    return json.dumps(get_safe(get_ns(data)).should_initiate(node, group))
+    return respond(get_safe(get_ns(data)).should_initiate(node, group))
 
 @app.route('/post_aggregate',methods=['POST'])
 def post_aggregate():
@@ -337,21 +324,27 @@ def post_aggregate():
             type: integer
           aggregate:
             type: string
+          chunk:
+            type: integer
+          chunks:
+            type: integer
     responses:
       200:
-       description: data input
+       description: data input, or the chunk status when chunk is set
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     from_node = data["from_node"]
     to_node = data["to_node"]
     group = 1
     if "group" in data:
       group = data["group"]
     aggregate = data["aggregate"]
+    if "chunk" in data:
+      return respond(get_safe(get_ns(data)).post_chunk(from_node, to_node, aggregate, data["chunk"], data["chunks"], group))
     get_safe(get_ns(data)).post_aggregate(from_node, to_node, aggregate, group)
-    return json.dumps(data)
+    return echo(data)
 
 @app.route('/check_aggregate',methods=['POST'])
 def check_aggregate():
@@ -379,12 +372,12 @@ def check_aggregate():
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     node = data["node"]
     group = 1
     if "group" in data:
       group = data["group"]
-    return json.dumps(get_safe(get_ns(data)).check_aggregate(node, group))
+    return respond(get_safe(get_ns(data)).check_aggregate(node, group))
 
 @app.route('/get_aggregate',methods=['POST'])
 def get_aggregate():
@@ -412,12 +405,12 @@ def get_aggregate():
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     node = data["node"]
     group = 1
     if "group" in data:
       group = data["group"]
-    return json.dumps(get_safe(get_ns(data)).get_aggregate(node, group))
+    return respond(get_safe(get_ns(data)).get_aggregate(node, group))
 
 @app.route('/post_average',methods=['POST'])
 def post_average():
@@ -451,7 +444,7 @@ def post_average():
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     node  = None
     if "node" in data:
       node = data["node"]
@@ -460,7 +453,7 @@ def post_average():
       group = data["group"]
     average = data["average"]
     get_safe(get_ns(data)).post_average(node, average, group)
-    return json.dumps(data)
+    return echo(data)
 
 @app.route('/get_average',methods=['POST'])
 def get_average():
@@ -485,11 +478,11 @@ def get_average():
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     node = None
     if "node" in data:
       node = data["node"]
-    return json.dumps(get_safe(get_ns(data)).get_average(node))
+    return respond(get_safe(get_ns(data)).get_average(node))
 
 @app.route('/register',methods=['POST'])
 def register():
@@ -503,20 +496,92 @@ def register():
         example:
           namespace: global
           pub_key: pub_key
+          group: 1
+          layout: true
+          lease: true
         properties:
           namespace:
             type: string
           pub_key:
             type: string
+          group:
+            type: integer
+          layout:
+            type: boolean
+          lease:
+            type: boolean
     responses:
       200:
-       description: index
+       description: index, the group assigned by the controller when layout is set and CHAIN_LENGTH or CHAIN_LATENCY_BUDGET is configured, and the lease time when lease is set and LEASE_TIME is configured
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     pub_key = data["pub_key"]
-    return json.dumps(get_safe(get_ns(data)).register(pub_key))
+    group = 1
+    if "group" in data:
+      group = data["group"]
+    layout = False
+    if "layout" in data:
+      layout = data["layout"]
+    lease = False
+    if "lease" in data:
+      lease = data["lease"]
+    return respond(get_safe(get_ns(data)).register(pub_key, group, layout, lease))
+
+@app.route('/heartbeat',methods=['POST'])
+def heartbeat():
+    """Renew the leases of a batch of public keys.
+    ---
+    tags:
+      - safe
+    parameters:
+      - name: payload
+        in: body
+        example:
+          namespace: global
+          pub_keys: [pub_key]
+        properties:
+          namespace:
+            type: string
+          pub_keys:
+            type: array
+            items:
+              type: string
+    responses:
+      200:
+       description: lease time
+    security:
+        - basic: []
+    """
+    data = get_data()
+    return respond(get_safe(get_ns(data)).heartbeat(data["pub_keys"]))
+
+@app.route('/unregister',methods=['POST'])
+def unregister():
+    """Remove a public key laid out in a group by the controller.
+    ---
+    tags:
+      - safe
+    parameters:
+      - name: payload
+        in: body
+        example:
+          namespace: global
+          pub_key: pub_key
+        properties:
+          namespace:
+            type: string
+          pub_key:
+            type: string
+    responses:
+      200:
+       description: ok, or empty if the key was not laid out by the controller
+    security:
+        - basic: []
+    """
+    data = get_data()
+    return respond(get_safe(get_ns(data)).unregister(data["pub_key"]))
 
 @app.route('/registrations',methods=['POST'])
 def get_registrations():
@@ -541,19 +606,46 @@ def get_registrations():
     security:
         - basic: []
     """
-    data = request.get_json(force=True)
+    data = get_data()
     group = 1
     if "group" in data:
       group = data["group"]
-    return json.dumps(get_safe(get_ns(data)).get_registrations(group))
+    return respond(get_safe(get_ns(data)).get_registrations(group))
 
 @app.route('/clear_data',methods=['POST'])
 def clear_data():
-  data = request.get_json(force=True)
+  data = get_data()
   get_safe(get_ns(data)).clear_data()
   get_bon(get_ns(data)).clear_data()
   get_insec(get_ns(data)).clear_data()
-  return json.dumps({"status":"OK"})
+  return respond({"status":"OK"})
+
+@app.route('/delete_namespace',methods=['POST'])
+def delete_namespace():
+    """Tear down all aggregation state and timers of a namespace.
+    ---
+    parameters:
+      - name: payload
+        in: body
+        example:
+          namespace: global
+        properties:
+          namespace:
+            type: string
+    responses:
+      200:
+       description: status whether OK
+    security:
+        - basic: []
+    """
+    data = get_data()
+    namespace = get_ns(data)
+    if auth_enabled:
+      response = check_user(namespace)
+      if isinstance(response, Response):
+        abort(401)
+    remove_namespace(namespace)
+    return respond({"status":"OK"})
 
 
 if __name__ == "__main__":
@@ -1,13 +1,60 @@
 #! /usr/bin/env python3
+import asyncio
 import time
 import os
-import threading
+import numpy as np
+from prebuilt import Prebuilt
+from store import get_store
+from waiters import Waiters, is_empty
 
-class InSec:
+# epochs kept after a newer one starts, for clients still waiting on them
+KEPT_EPOCHS = 3
+
+
+class InSecEpoch:
+  """Running sum and count of the models posted in one epoch. The average
+  is computed once and shared by every waiter.
+  """
   def __init__(self):
+    self.total = None
+    self.count = 0
+    self.result = None
+
+  def add(self, coef):
+    if self.total is None:
+      self.total = np.zeros(len(coef))
+    self.total += coef
+    self.count += 1
+    self.result = None
+
+  def get_result(self):
+    if self.result is None:
+      self.result = Prebuilt({"coef": self.total/self.count})
+    return self.result
+
+  def __getstate__(self):
+    # the shared response is rebuilt on demand after a reload
+    state = dict(self.__dict__)
+    state["result"] = None
+    return state
+
+
+class InSec:
+  def __init__(self, namespace="global"):
+    self.key = "%s/insec" % namespace
+    self.store = get_store()
     self.nodes = {}
-    self.lock = threading.Semaphore()
+    self.epochs = {}
+    self.lock = self.store.lock(self, self.key)
+    self.waiters = Waiters(self.lock, self.store.poll_interval)
    
+    progress_timeout_env = os.getenv("PROGRESS_TIMEOUT")
+    if progress_timeout_env is None or progress_timeout_env == "":
+      progress_timeout = 60
+    else:
+      progress_timeout = float(progress_timeout_env)
+    self.config = {}
+    self.config["progress_timeout"] = progress_timeout
     should_debug_env = os.getenv("SHOULD_DEBUG")
     if should_debug_env is None or should_debug_env == "":
       self.should_debug = False
@@ -20,47 +67,75 @@ class InSec:
     with open("controller.debug",'a') as f:
       f.write("INSEC DEBUG [%.3f] %s\n" % (time.time(),msg))
 
-  def get_avg(self):
-    avg = {}
-    n = len(self.nodes)
-    for node in self.nodes.keys():
-      if not "coef" in avg:
-        avg["coef"] = [0]*len(self.nodes[node]["coef"])
-      for i in range(0,len(self.nodes[node]["coef"])):
-        avg["coef"][i] += self.nodes[node]["coef"][i]
-    for i in range(0, len(avg["coef"])):
-      avg["coef"][i] = avg["coef"][i]/n
-    return avg 
-
-  def get_posted(self, epoch):
-    posted = 0
-    with self.lock:
-      for n in self.nodes.keys():
-        if self.nodes[n]["epoch"] == epoch:
-          posted += 1
-    return posted
+  def get_state(self):
+    return {"nodes": self.nodes, "epochs": self.epochs}
 
-  def wait_for(self, total_nodes, epoch):
-    posted = self.get_posted(epoch)
-    while posted < total_nodes:
-      posted = self.get_posted(epoch)
-      time.sleep(0.01)
+  def set_state(self, state):
+    self.__dict__.update(state)
 
-  def update_model(self, node, coef, total_nodes):
-    self.debug("Node %d posting and waiting for %d updates" % (node, total_nodes))
+  def get_epoch(self, epoch):
+    # caller holds self.lock
+    if not epoch in self.epochs:
+      self.epochs[epoch] = InSecEpoch()
+      for old in [e for e in self.epochs.keys() if e <= epoch - KEPT_EPOCHS]:
+        del self.epochs[old]
+    return self.epochs[epoch]
+
+  def internal_get_model(self, params):
+    """Complete once total_nodes nodes have posted for the epoch. Past the
+    deadline the epoch is averaged over the nodes that posted, the way
+    SAFE skips nodes that fail.
+    """
+    state = self.get_epoch(params["epoch"])
+    if state.count < params["total_nodes"] and (params["deadline"] is None or time.time() < params["deadline"]):
+      return {"status": "empty"}
+    if state.count == 0:
+      return {"status": "empty"}
+    return state.get_result()
+
+  def post_model(self, node, coef):
+    coef = np.asarray(coef, dtype=np.float64).ravel()
     with self.lock:
       if node not in self.nodes:
          self.nodes[node] = {"epoch": 0}
-      self.nodes[node]["coef"] = coef
       self.nodes[node]["epoch"] += 1
-    self.debug("Node %d waiting for %d updates in epoch %d" % (node, total_nodes, self.nodes[node]["epoch"]))
-    self.wait_for(total_nodes,self.nodes[node]["epoch"]) 
-    with self.lock:
-      avg = self.get_avg()
+      epoch = self.nodes[node]["epoch"]
+      self.get_epoch(epoch).add(coef)
+      self.waiters.notify(("epoch", epoch))
+    return epoch
+
+  def deadline(self):
+    # when a waiting epoch is averaged over the nodes that posted, None waits for all
+    if self.config["progress_timeout"] <= 0:
+      return None
+    return time.time() + self.config["progress_timeout"]
+
+  def update_model(self, node, coef, total_nodes):
+    self.debug("Node %d posting and waiting for %d updates" % (node, total_nodes))
+    epoch = self.post_model(node, coef)
+    self.debug("Node %d waiting for %d updates in epoch %d" % (node, total_nodes, epoch))
+    params = {"epoch": epoch, "total_nodes": total_nodes, "deadline": self.deadline()}
+    avg = self.waiters.poll(self.internal_get_model, params, ("epoch", epoch), self.config["progress_timeout"])
+    return self.model_result(avg)
+
+  async def aupdate_model(self, node, coef, total_nodes):
+    self.debug("Node %d posting and waiting for %d updates" % (node, total_nodes))
+    epoch = await self.waiters.call(asyncio.get_running_loop(), self.post_model, node, coef)
+    params = {"epoch": epoch, "total_nodes": total_nodes, "deadline": self.deadline()}
+    avg = await self.waiters.apoll(self.internal_get_model, params, ("epoch", epoch), self.config["progress_timeout"])
+    return self.model_result(avg)
+
+  def model_result(self, avg):
+    if is_empty(avg):
+      self.debug("Timed out waiting for updates")
+      return {"status": "timeout"}
     self.debug("Data: %s" % avg)
     return avg
 
   def clear_data(self):
     with self.lock:
       self.nodes = {}
-      return {"status":"OK"}
+      self.epochs = {}
+      self.waiters.notify_all()
+    self.store.remove(self.key)
+    return {"status":"OK"}
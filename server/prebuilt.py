@@ -0,0 +1,27 @@
+#! /usr/bin/env python3
+import wire
+
+
+class Prebuilt(dict):
+  """A result shared by many waiters. Its JSON body and binary frame are
+  serialized once, on first use, and it must not be modified.
+  """
+  def __init__(self, result):
+    super().__init__(result)
+    self.body = None
+    self.frame = None
+
+
+def dumps(result):
+  if isinstance(result, Prebuilt):
+    if result.body is None:
+      result.body = wire.dumps(result)
+    return result.body
+  return wire.dumps(result)
+
+def pack(result):
+  if isinstance(result, Prebuilt):
+    if result.frame is None:
+      result.frame = wire.encode(result)
+    return result.frame
+  return wire.encode(result)
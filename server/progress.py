@@ -1,24 +1,68 @@
 #! /usr/bin/env python3
-
-import requests
-import os
+import heapq
+import itertools
+import threading
 import time
-import json
-import sys
+import traceback
+
+
+class Timer:
+  def __init__(self, deadline, callback, args):
+    self.deadline = deadline
+    self.callback = callback
+    self.args = args
+    self.active = True
+
+  def cancel(self):
+    self.active = False
+
+
+class ProgressScheduler(threading.Thread):
+  """Controller-wide deadline heap shared by all namespaces.
+
+  A single thread sleeps until the earliest deadline and fires its
+  callback. Cancelled timers are dropped lazily when they reach the top
+  of the heap, so cancelling is O(1).
+  """
+  def __init__(self):
+    threading.Thread.__init__(self, daemon=True)
+    self.heap = []
+    self.counter = itertools.count()
+    self.cond = threading.Condition()
+
+  def schedule(self, delay, callback, *args):
+    timer = Timer(time.time() + delay, callback, args)
+    with self.cond:
+      heapq.heappush(self.heap, (timer.deadline, next(self.counter), timer))
+      if self.heap[0][2] is timer:
+        self.cond.notify()
+    return timer
 
-progress_timeout_env = os.getenv("PROGRESS_TIMEOUT")
-if progress_timeout_env is None or progress_timeout_env == "":
-  progress_timeout = 60
-else:
-  progress_timeout = float(progress_timeout_env)
+  def run(self):
+    while True:
+      with self.cond:
+        while len(self.heap) == 0 or not self.heap[0][2].active or self.heap[0][0] > time.time():
+          if len(self.heap) > 0 and not self.heap[0][2].active:
+            heapq.heappop(self.heap)
+          elif len(self.heap) == 0:
+            self.cond.wait()
+          else:
+            self.cond.wait(self.heap[0][0] - time.time())
+        (_, _, timer) = heapq.heappop(self.heap)
+      if timer.active:
+        try:
+          timer.callback(*timer.args)
+        except Exception:
+          traceback.print_exc()
 
-if progress_timeout == 0:
-  sys.exit(0)
 
-while 1:
-  try:  
-    time.sleep(progress_timeout/2)
-    data = requests.post("http://localhost:8088/check_progress",json={})
-  except:
-     pass
+scheduler = None
+scheduler_lock = threading.Lock()
 
+def get_scheduler():
+  global scheduler
+  with scheduler_lock:
+    if scheduler is None:
+      scheduler = ProgressScheduler()
+      scheduler.start()
+    return scheduler
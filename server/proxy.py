@@ -1,18 +1,127 @@
 #! /usr/bin/env python3
-from flask import Flask, request
+from aiohttp import web
+import aiohttp
+import bisect
+import hashlib
 import json
-import requests
+import os
+import sys
+import wire
 
-app = Flask(__name__)
+# Routing tier in front of several controllers. Requests are relayed
+# concurrently over pooled keep-alive connections to the backend that owns
+# their namespace on a consistent hash ring, so namespaces scale out over
+# backends and adding one only moves the namespaces next to it on the ring.
+#
+# SAFE combines the group averages of a namespace in one backend, so groups
+# are only spread over backends (SHARD_BY_GROUP=yes) when the backends share
+# their state through STATE_STORE.
 
-@app.route('/<path>',methods=['POST'])
-def post_op(path):
-    data = request.get_json(force=True)
+controller_backends_env = os.getenv("CONTROLLER_BACKENDS")
+if controller_backends_env is None or controller_backends_env == "":
+  backends = ["http://localhost:8089"]
+else:
+  backends = [backend.strip().rstrip("/") for backend in controller_backends_env.split(",")]
+
+shard_by_group_env = os.getenv("SHARD_BY_GROUP")
+shard_by_group = not shard_by_group_env is None and shard_by_group_env == "yes"
+
+proxy_connections_env = os.getenv("PROXY_CONNECTIONS")
+if proxy_connections_env is None or proxy_connections_env == "":
+  proxy_connections = 1000
+else:
+  proxy_connections = int(proxy_connections_env)
+
+# points per backend on the ring, evening out the share of each backend
+REPLICAS = 100
+# request headers relayed to the backends
+RELAYED_HEADERS = ["Content-Type", "Accept", "Authorization"]
+
+
+def ring_hash(key):
+  return int.from_bytes(hashlib.md5(key.encode("utf8")).digest()[:8], "big")
+
+
+class HashRing:
+  def __init__(self, nodes, replicas=REPLICAS):
+    points = []
+    for node in nodes:
+      for replica in range(replicas):
+        points.append((ring_hash("%s#%d" % (node, replica)), node))
+    points.sort()
+    self.hashes = [point[0] for point in points]
+    self.nodes = [point[1] for point in points]
+
+  def get(self, key):
+    i = bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+    return self.nodes[i]
+
+
+ring = HashRing(backends)
+
+def shard_key(request, body):
+  if request.content_type == wire.CONTENT_TYPE:
+    data = wire.decode(body)
+  else:
     try:
-      data = requests.post('http://localhost:8089/%s' % path,json=data)
-    except:
-      return json.dumps({"status": "empty"}) 
-    return data.text
+      data = json.loads(body)
+    except ValueError:
+      data = {}
+  if not isinstance(data, dict):
+    data = {}
+  key = str(data.get("namespace", "global"))
+  if shard_by_group:
+    key += "/%s" % data.get("group", 1)
+  return key
+
+def relayed_headers(request):
+  return {name: request.headers[name] for name in RELAYED_HEADERS if name in request.headers}
+
+async def post_op(request):
+  body = await request.read()
+  url = "%s/%s" % (ring.get(shard_key(request, body)), request.match_info["path"])
+  try:
+    async with request.app["session"].post(url, data=body, headers=relayed_headers(request)) as upstream:
+      data = await upstream.read()
+      return web.Response(body=data, status=upstream.status, content_type=upstream.content_type)
+  except aiohttp.ClientError:
+    # clients poll again on an empty result
+    return web.json_response({"status": "empty"})
+
+async def stream_op(request):
+  """Relays a server-sent event stream as it is produced."""
+  body = await request.read()
+  url = "%s/stream/%s" % (ring.get(shard_key(request, body)), request.match_info["path"])
+  try:
+    async with request.app["session"].post(url, data=body, headers=relayed_headers(request)) as upstream:
+      if upstream.status != 200:
+        return web.Response(body=await upstream.read(), status=upstream.status, content_type=upstream.content_type)
+      response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+      await response.prepare(request)
+      async for data in upstream.content.iter_any():
+        await response.write(data)
+      await response.write_eof()
+      return response
+  except aiohttp.ClientError:
+    return web.json_response({"status": "empty"}, status=502)
+
+async def start_session(app):
+  # no total timeout, long polls and streams are held open by the backends
+  connector = aiohttp.TCPConnector(limit=proxy_connections)
+  app["session"] = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None))
+
+async def close_session(app):
+  await app["session"].close()
+
+app = web.Application()
+app.on_startup.append(start_session)
+app.on_cleanup.append(close_session)
+app.router.add_post('/stream/{path}', stream_op)
+app.router.add_post('/{path}', post_op)
+
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8088, debug=True, threaded=False)
+    port = 8088
+    if len(sys.argv) > 1:
+       port = int(sys.argv[1])
+    web.run_app(app, host="0.0.0.0", port=port)
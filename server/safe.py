@@ -1,31 +1,93 @@
 #! /usr/bin/env python3
 import time
+import math
 import os
-import threading
+from waiters import Waiters
+from prebuilt import Prebuilt
+from progress import get_scheduler
+from store import get_store, snapshot
 
+# weight of the latest hop in the smoothed hop time
+HOP_SMOOTHING = 0.2
+# weight of the latest sample in the smoothed time a node takes to forward what it consumed
+LATENCY_SMOOTHING = 0.125
+# samples needed before a node's deadline follows its latency
+MIN_LATENCY_SAMPLES = 3
+# least deviation assumed, so jitter on a quiet network does not skip live nodes
+MIN_LATENCY_DEVIATION = 0.25
+# share of progress_timeout a deadline is never shortened below
+MIN_DEADLINE_SHARE = 0.1
 
-class ProgressThread(threading.Thread):
-  def __init__(self, safe):
-    threading.Thread.__init__(self)
+class SafeGroup:
+  """State of one aggregation group (chain). Each group has its own lock
+  and waiters so groups run in parallel without contending.
+  """
+  def __init__(self, safe, group):
     self.safe = safe
-    progress_timeout_env = os.getenv("PROGRESS_TIMEOUT")
-    if progress_timeout_env is None or progress_timeout_env == "":
-      self.interval = 30
-    else:
-      self.interval = float(progress_timeout_env)/2
-  def run(self):
-    while (True):
-      self.safe.check_progress()
-      time.sleep(self.interval)
-
-class Safe:
-  def __init__(self):
-    self.nodes = {}
+    self.group = group
     self.aggregate = {}
     self.repost_aggregate = {}
-    self.average = {}
-    self.group_stats = {}
+    self.average = None
+    self.stats = {"posted":0,"skipped":0}
+    self.hops = set()
+    # nodes that posted this round, a second post from one of them is a repost
+    self.senders = set()
+    self.last_hop = time.time()
+    # smoothed time each node takes from consuming an aggregate to forwarding it, kept across rounds
+    self.latency = {}
+    # the same over all nodes of the chain, for nodes with few samples of their own
+    self.chain_latency = None
+    # nodes that consumed an aggregate or chunk and have not forwarded it yet
+    self.forwarding = {}
+    # nodes skipped this round, whatever they post late is dropped
+    self.failed = set()
+    # when each node last polled for its aggregate
+    self.seen = {}
     self.registrations = {}
+    self.lock = safe.store.lock(self, "%s/%s" % (safe.key, group))
+    self.waiters = Waiters(self.lock, safe.store.poll_interval)
+
+  def get_state(self):
+    # progress timers belong to the process that set them
+    aggregate = {}
+    for (node, pending) in self.aggregate.items():
+      aggregate[node] = {key: value for (key, value) in pending.items() if key != "timer"}
+    forwarding = {}
+    for (node, pending) in self.forwarding.items():
+      forwarding[node] = {key: value for (key, value) in pending.items() if key != "timer"}
+    return snapshot({"aggregate": aggregate, "repost_aggregate": self.repost_aggregate, "average": self.average,
+            "stats": self.stats, "hops": self.hops, "senders": self.senders, "last_hop": self.last_hop, "latency": self.latency,
+            "chain_latency": self.chain_latency, "forwarding": forwarding, "failed": self.failed,
+            "seen": self.seen, "registrations": self.registrations})
+
+  def set_state(self, state):
+    self.__dict__.update(state)
+
+  def init_average(self, initiator=1):
+    self.average = {"status": "initiated", "time": time.time(), "initiator": initiator}
+    self.stats = {"posted":0,"skipped":0}
+    self.hops = set()
+    self.senders = set()
+    self.failed = set()
+    self.last_hop = self.average["time"]
+    self.cancel_timers()
+    self.aggregate = {}
+    self.forwarding = {}
+    self.safe.withdraw_average(self.group)
+
+  def cancel_timers(self):
+    for pending in list(self.aggregate.values()) + list(self.forwarding.values()):
+      if "timer" in pending:
+        pending["timer"].cancel()
+
+
+class Safe:
+  def __init__(self, namespace="global"):
+    self.key = "%s/safe" % namespace
+    self.store = get_store()
+    self.groups = {}
+    self.init_totals()
+    self.init_layout()
 
     should_debug_env = os.getenv("SHOULD_DEBUG")
     if should_debug_env is None or should_debug_env == "":
@@ -48,20 +110,44 @@ class Safe:
       poll_time = 10
     else:
       poll_time = float(poll_time_env)
-    yield_time_env = os.getenv("YIELD_TIME")
-    if yield_time_env is None or yield_time_env == "":
-      yield_time = 0.005
+    max_queued_chunks_env = os.getenv("MAX_QUEUED_CHUNKS")
+    if max_queued_chunks_env is None or max_queued_chunks_env == "":
+      max_queued_chunks = 8
+    else:
+      max_queued_chunks = int(max_queued_chunks_env)
+    chain_length_env = os.getenv("CHAIN_LENGTH")
+    if chain_length_env is None or chain_length_env == "":
+      chain_length = 0
+    else:
+      chain_length = int(chain_length_env)
+    failure_threshold_env = os.getenv("FAILURE_THRESHOLD")
+    if failure_threshold_env is None or failure_threshold_env == "":
+      failure_threshold = 0
     else:
-      yield_time = float(yield_time_env)
+      failure_threshold = float(failure_threshold_env)
+    lease_time_env = os.getenv("LEASE_TIME")
+    if lease_time_env is None or lease_time_env == "":
+      lease_time = 0
+    else:
+      lease_time = float(lease_time_env)
+    chain_latency_budget_env = os.getenv("CHAIN_LATENCY_BUDGET")
+    if chain_latency_budget_env is None or chain_latency_budget_env == "":
+      chain_latency_budget = 0
+    else:
+      chain_latency_budget = float(chain_latency_budget_env)
     self.config = {}
     self.config["progress_timeout"] = progress_timeout
     self.config["aggregation_timeout"] = aggregation_timeout
     self.config["poll_time"] = poll_time
-    self.config["yield_time"] = yield_time
+    self.config["max_queued_chunks"] = max_queued_chunks
+    self.config["chain_length"] = chain_length
+    self.config["chain_latency_budget"] = chain_latency_budget
+    self.config["failure_threshold"] = failure_threshold
+    self.config["lease_time"] = lease_time
 
-    self.lock = threading.Semaphore()
-    self.progress_thread = ProgressThread(self)
-    self.progress_thread.start()
+    self.lock = self.store.lock(self, self.key)
+    self.waiters = Waiters(self.lock, self.store.poll_interval)
+    self.scheduler = get_scheduler()
 
   def debug(self, msg):
     if not self.should_debug:
@@ -69,98 +155,395 @@ class Safe:
     with open("controller.debug",'a') as f:
       f.write("SAFE DEBUG [%.3f] %s\n" % (time.time(),msg))
 
-  def init_average(self, group, initiator=1):
-    self.average[group] = {"status": "initiated", "time": time.time(), "initiator": initiator}
-    self.group_stats[group] = {"posted":0,"skipped":0}
-    if group in self.aggregate:
-      del self.aggregate[group]
+  def get_group(self, group):
+    state = self.groups.get(group)
+    if state is None:
+      with self.lock:
+        state = self.groups.setdefault(group, SafeGroup(self, group))
+    return state
 
   def should_initiate(self, node, group=1):
-    with self.lock:
+    state = self.get_group(group)
+    with state.lock:
       current_time = time.time()
-      if not group in average: 
-        self.init_average(group, node)
+      head = self.head(state)
+      if not head is None:
+        # with leases the head of the live members initiates every round
+        if node == head:
+          state.init_average(node)
+        return {"init": node == head}
+      if state.average is None:
+        state.init_average(node)
         return {"init": True}
-      self.debug("Elapsed time: %.2f" % (current_time - self.average[group]["time"]))
-      if (current_time - self.average[group]["time"]) > self.config["aggregation_timeout"]:
-        self.init_average(group, node)
+      self.debug("Elapsed time: %.2f" % (current_time - state.average["time"]))
+      if (current_time - state.average["time"]) > self.config["aggregation_timeout"]:
+        state.init_average(node)
         return {"init": True}
       return {"init": False}
 
+  def head(self, state):
+    """Lowest index of the live members of the group of state when nodes
+    hold leases, None otherwise. Caller holds state.lock.
+    """
+    if self.config["lease_time"] <= 0:
+      return None
+    current_time = time.time()
+    with self.lock:
+      live = [index for (index, pub_key) in self.members(state).items() if self.live(pub_key, current_time)]
+    if len(live) == 0:
+      return None
+    return min(live)
+
+  def initiates(self, state, node):
+    # whether a post from node starts a round, caller holds state.lock
+    head = self.head(state)
+    if not head is None:
+      return node == head
+    return state.average is None or state.average["initiator"] == node
+
+  def members(self, state):
+    """Index to public key of the nodes of the group of state. Caller
+    holds state.lock and self.lock.
+    """
+    if len(self.positions) > 0:
+      return {index: pub_key for (pub_key, (chain, index)) in self.positions.items() if chain == state.group}
+    return {registration["index"]: pub_key for (pub_key, registration) in state.registrations.items()}
+
+  def repost_target(self, state, failed):
+    """Node the predecessor of failed reposts to: the first node after
+    failed known to be alive, because it polled for its aggregate within
+    the last long poll or holds a lease, wrapping around past the tail to
+    the head of the chain, where the initiator polls for the final
+    aggregate. All nodes of a chain poll from the start of a round, so
+    this probes the successors at once and a run of dead nodes, at the
+    tail too, costs one progress timeout. Without such evidence it is the
+    next node. Caller holds state.lock.
+    """
+    current_time = time.time()
+    with self.lock:
+      members = self.members(state)
+      nodes = sorted(members.keys())
+      for node in [i for i in nodes if i > failed] + [i for i in nodes if i < failed]:
+        if current_time - state.seen.get(node, 0) <= 2 * self.config["poll_time"]:
+          return node
+        if members[node] in self.leases and self.live(members[node], current_time):
+          return node
+    return failed + 1
+
   def post_aggregate(self, from_node, to_node, aggregate, group=1):
     self.debug("post_aggregate: %s" % from_node)
-    with self.lock:
+    state = self.get_group(group)
+    with state.lock:
       self.debug("Posting Aggregate: %s" % aggregate)
-      if group in self.average and self.average[group]["initiator"] == from_node:
-        self.init_average(group, from_node)
-      elif group not in self.average:
-        self.init_average(group, from_node)
-
-      if not group in self.aggregate:
-        self.aggregate[group] = {}
-      self.aggregate[group][to_node] = {"aggregate": aggregate, "time": time.time(), "from_node": from_node}
-      self.group_stats[group]["posted"] += 1
-      if group not in self.repost_aggregate:
-        self.repost_aggregate[group] = {}
-      self.repost_aggregate[group][from_node] =  {"status": "consumed"}
-      self.repost_aggregate[group][to_node] =  {"status": "empty"}
+      if self.initiates(state, from_node):
+        state.init_average(from_node)
+      if from_node in state.failed:
+        # from_node was skipped after it consumed, its predecessor reposted past it
+        return False
+      self.forwarded(state, from_node)
+
+      if to_node in state.aggregate and "timer" in state.aggregate[to_node]:
+        state.aggregate[to_node]["timer"].cancel()
+      state.aggregate[to_node] = {"aggregate": aggregate, "from_node": from_node}
+      self.observe_hop(state, from_node)
+      self.arm(state, to_node)
+      state.stats["posted"] += 1
+      state.repost_aggregate[from_node] =  {"status": "consumed"}
+      state.repost_aggregate[to_node] =  {"status": "empty"}
+      state.waiters.notify(("aggregate", to_node))
+      state.waiters.notify(("check", from_node))
       return True 
 
+  def observe_hop(self, state, from_node):
+    # smooths the time between hops of a chain, caller holds state.lock
+    if self.config["chain_latency_budget"] <= 0:
+      return
+    current_time = time.time()
+    first = len(state.senders) == 0
+    repost = from_node in state.senders
+    state.senders.add(from_node)
+    if first or repost:
+      # the first hop follows init_average and a repost follows a skip, neither is a hop time
+      state.last_hop = current_time
+      return
+    with self.lock:
+      hop = current_time - state.last_hop
+      if self.hop_time is None:
+        self.hop_time = hop
+      else:
+        self.hop_time += HOP_SMOOTHING * (hop - self.hop_time)
+    state.last_hop = current_time
+
+  def arm(self, state, node):
+    # restarts the progress deadline of the hop into node, caller holds state.lock
+    pending = state.aggregate[node]
+    if "timer" in pending:
+      pending["timer"].cancel()
+      del pending["timer"]
+    pending["time"] = time.time()
+    if "chunks" in pending and len(pending["chunks"]) == 0:
+      # nothing is waiting to be consumed, the receiver is not late
+      return
+    if self.config["progress_timeout"] > 0:
+      pending["timer"] = self.scheduler.schedule(self.deadline(state, node), self.expire, state, node, pending["time"])
+
+  def deadline(self, state, node):
+    """Time node may take to consume what is posted to it, or to forward
+    what it consumed, before it is skipped: progress_timeout, or sooner
+    once node is failure_threshold deviations overdue on its smoothed
+    time from consuming an aggregate to forwarding it, or on that of its
+    chain while it has few samples of its own, but not below a share of
+    progress_timeout. A live node polls for its aggregate from the start
+    of a round and consumes it at once, so a node that never polled is as
+    overdue as one that died holding the aggregate. Nodes waiting on a
+    full queue downstream are not late and get the whole progress_timeout.
+    Caller holds state.lock.
+    """
+    timeout = self.config["progress_timeout"]
+    if self.config["failure_threshold"] <= 0:
+      return timeout
+    estimate = state.latency.get(node)
+    if estimate is None or estimate["samples"] < MIN_LATENCY_SAMPLES:
+      estimate = state.chain_latency
+    if estimate is None or estimate["samples"] < MIN_LATENCY_SAMPLES:
+      return timeout
+    for pending in state.aggregate.values():
+      if pending.get("from_node") == node and len(pending.get("chunks", {})) >= self.config["max_queued_chunks"]:
+        return timeout
+    deviation = max(math.sqrt(estimate["var"]), MIN_LATENCY_DEVIATION)
+    return min(timeout, max(MIN_DEADLINE_SHARE * timeout, estimate["mean"] + self.config["failure_threshold"] * deviation))
+
+  def consumed(self, state, node):
+    # arms the deadline for node to forward what it consumed, caller holds state.lock
+    if self.initiates(state, node):
+      # the initiator ends the round with post_average
+      return
+    previous = state.forwarding.get(node)
+    if not previous is None and "timer" in previous:
+      previous["timer"].cancel()
+    forwarding = {"time": time.time()}
+    state.forwarding[node] = forwarding
+    if self.config["progress_timeout"] > 0:
+      forwarding["timer"] = self.scheduler.schedule(self.deadline(state, node), self.expire_forward, state, node, forwarding["time"])
+
+  def forwarded(self, state, node):
+    # node passed on what it consumed, caller holds state.lock
+    forwarding = state.forwarding.pop(node, None)
+    if forwarding is None:
+      return
+    if "timer" in forwarding:
+      forwarding["timer"].cancel()
+    latency = time.time() - forwarding["time"]
+    state.latency[node] = self.smooth(state.latency.get(node), latency)
+    state.chain_latency = self.smooth(state.chain_latency, latency)
+
+  def smooth(self, estimate, sample):
+    # smoothed mean and variance of a latency
+    if estimate is None:
+      return {"mean": sample, "var": 0.0, "samples": 1}
+    diff = sample - estimate["mean"]
+    estimate["mean"] += LATENCY_SMOOTHING * diff
+    estimate["var"] = (1 - LATENCY_SMOOTHING) * (estimate["var"] + LATENCY_SMOOTHING * diff * diff)
+    estimate["samples"] += 1
+    return estimate
+
+  def internal_post_chunk(self, params):
+    state = params["state"]
+    from_node = params["from_node"]
+    to_node = params["to_node"]
+    chunk = params["chunk"]
+    if chunk == 0 and self.initiates(state, from_node):
+      state.init_average(from_node)
+    if from_node in state.failed:
+      # from_node was skipped, its predecessor reposted past it
+      return {"status": "skipped"}
+    self.forwarded(state, from_node)
+    if chunk == 0:
+      # a new stream, or a restart after a repost, replaces what is queued
+      previous = state.aggregate.get(to_node)
+      if not previous is None and "timer" in previous:
+        previous["timer"].cancel()
+      if not previous is None and previous.get("from_node") != from_node and (previous.get("from_node"), to_node) in state.hops:
+        # a repost replaces the stream of a skipped sender, to_node throws that hop away
+        state.hops.discard((previous["from_node"], to_node))
+        state.stats["posted"] -= 1
+      state.aggregate[to_node] = {"chunks": {}, "count": params["chunks"], "from_node": from_node}
+      if not (from_node, to_node) in state.hops:
+        state.hops.add((from_node, to_node))
+        state.stats["posted"] += 1
+        self.observe_hop(state, from_node)
+      state.repost_aggregate[to_node] =  {"status": "empty"}
+    pending = state.aggregate.get(to_node)
+    if pending is None or pending.get("from_node") != from_node or not "chunks" in pending:
+      # to_node was skipped, the sender will be asked to repost
+      return {"status": "skipped"}
+    if len(pending["chunks"]) >= self.config["max_queued_chunks"]:
+      return {"status": "empty"}
+    pending["chunks"][chunk] = params["aggregate"]
+    self.arm(state, to_node)
+    state.waiters.notify(("aggregate", to_node))
+    if chunk == pending["count"] - 1:
+      state.repost_aggregate[from_node] =  {"status": "consumed"}
+      state.waiters.notify(("check", from_node))
+    return {"status": "ok"}
+
+  def post_chunk(self, from_node, to_node, aggregate, chunk, chunks, group=1):
+    """Queues one chunk of an aggregate for to_node. At most
+    max_queued_chunks chunks are held per hop, beyond that the post
+    waits for the receiver to consume one.
+    """
+    self.debug("post_chunk: %s chunk %s/%s" % (from_node, chunk, chunks))
+    state = self.get_group(group)
+    params = {"state": state, "from_node": from_node, "to_node": to_node, "aggregate": aggregate, "chunk": chunk, "chunks": chunks}
+    return self.poll_internal(state.waiters, self.internal_post_chunk, params, ("space", to_node))
+
+  async def apost_chunk(self, from_node, to_node, aggregate, chunk, chunks, group=1):
+    self.debug("post_chunk: %s chunk %s/%s" % (from_node, chunk, chunks))
+    state = self.get_group(group)
+    params = {"state": state, "from_node": from_node, "to_node": to_node, "aggregate": aggregate, "chunk": chunk, "chunks": chunks}
+    return await self.apoll_internal(state.waiters, self.internal_post_chunk, params, ("space", to_node))
+
   def internal_check_aggregate(self, params):
+    state = params["state"]
     node = params["node"]
-    group = params["group"]
     result = {"status": "empty"}
-    if group in self.repost_aggregate and node in self.repost_aggregate[group]:
-      result = self.repost_aggregate[group][node] 
-      del self.repost_aggregate[group][node]
+    if node in state.repost_aggregate:
+      result = state.repost_aggregate[node] 
+      del state.repost_aggregate[node]
     return result
 
-  def poll_internal(self, func, params):
-    TIMEOUT = self.config["poll_time"]
-    WAIT_TIME = self.config["yield_time"]
-    empty = True
-    start_time =  time.time()
-    with self.lock:
-      result = func(params)
-    empty =  ("status" in result) and (result["status"] == "empty")
-    while empty and (time.time() - start_time) < TIMEOUT:
-      time.sleep(WAIT_TIME)
-      with self.lock:
-        result = func(params)
-        empty =  ("status" in result) and (result["status"] == "empty")
-    return result
+  def poll_internal(self, waiters, func, params, key):
+    return waiters.poll(func, params, key, self.config["poll_time"])
+
+  async def apoll_internal(self, waiters, func, params, key):
+    return await waiters.apoll(func, params, key, self.config["poll_time"])
 
   def check_aggregate(self, node, group=1):
-    return self.poll_internal(self.internal_check_aggregate, {"node": node, "group": group})
+    state = self.get_group(group)
+    return self.poll_internal(state.waiters, self.internal_check_aggregate, {"node": node, "state": state}, ("check", node))
+
+  async def acheck_aggregate(self, node, group=1):
+    state = self.get_group(group)
+    return await self.apoll_internal(state.waiters, self.internal_check_aggregate, {"node": node, "state": state}, ("check", node))
 
   def internal_get_aggregate(self, params):
+    state = params["state"]
     node = params["node"]
-    group = params["group"]
+    state.seen[node] = time.time()
     result = {"status": "empty"}
-    if group in self.aggregate and node in self.aggregate[group]:
+    if node in state.aggregate and "chunks" in state.aggregate[node]:
+      return self.next_chunk(state, node)
+    if node in state.aggregate:
       result = {"status": "ok"}
-      if "aggregate" in self.aggregate[group][node]:
-        result["aggregate"] = self.aggregate[group][node]["aggregate"]
-      if "from_node" in self.aggregate[group][node]:
-        result["from_node"] = self.aggregate[group][node]["from_node"]
-      del self.aggregate[group][node]
-      result["posted"] = self.group_stats[group]["posted"] - self.group_stats[group]["skipped"] 
+      if "timer" in state.aggregate[node]:
+        state.aggregate[node]["timer"].cancel()
+      if "aggregate" in state.aggregate[node]:
+        result["aggregate"] = state.aggregate[node]["aggregate"]
+      if "from_node" in state.aggregate[node]:
+        result["from_node"] = state.aggregate[node]["from_node"]
+      del state.aggregate[node]
+      self.consumed(state, node)
+      result["posted"] = state.stats["posted"] - state.stats["skipped"] 
+    return result
+
+  def next_chunk(self, state, node):
+    # chunks are handed out in order, the last one completes the hop
+    pending = state.aggregate[node]
+    if len(pending["chunks"]) == 0:
+      return {"status": "empty"}
+    chunk = min(pending["chunks"])
+    result = {"status": "ok", "aggregate": pending["chunks"].pop(chunk), "from_node": pending["from_node"], "chunk": chunk, "chunks": pending["count"]}
+    if chunk == pending["count"] - 1:
+      if "timer" in pending:
+        pending["timer"].cancel()
+      del state.aggregate[node]
+    else:
+      self.arm(state, node)
+    self.consumed(state, node)
+    state.waiters.notify(("space", node))
+    result["posted"] = state.stats["posted"] - state.stats["skipped"]
     return result
 
   def get_aggregate(self, node, group=1):
     self.debug("get_aggregate: %s" % node)
-    return self.poll_internal(self.internal_get_aggregate, {"node": node, "group": group})
+    state = self.get_group(group)
+    return self.poll_internal(state.waiters, self.internal_get_aggregate, {"node": node, "state": state}, ("aggregate", node))
+
+  async def aget_aggregate(self, node, group=1):
+    self.debug("get_aggregate: %s" % node)
+    state = self.get_group(group)
+    return await self.apoll_internal(state.waiters, self.internal_get_aggregate, {"node": node, "state": state}, ("aggregate", node))
 
   def post_average(self, node, average, group=1):
     self.debug("post_average: %s" % node)
-    with self.lock:
-      self.average[group]["average"] = average
-      self.average[group]["status"] = "posted"
-      if group not in self.repost_aggregate:
-        self.repost_aggregate[group] = {}
+    state = self.get_group(group)
+    with state.lock:
+      if state.average is None:
+        state.init_average(node)
+      state.average["average"] = average
+      state.average["status"] = "posted"
+      # skipped hops carried no value, the group average is over its contributors
+      self.contribute_average(group, average, state.stats["posted"] - state.stats["skipped"])
       if not node is None:
-        self.repost_aggregate[group][node] =  {"status": "consumed"}
-      return True
+        state.repost_aggregate[node] =  {"status": "consumed"}
+        state.waiters.notify(("check", node))
+    return True
+
+  def init_totals(self):
+    # weighted sum of the current group averages, guarded by self.lock
+    self.tot = None
+    self.tot_n = 0
+    self.contributions = {}
+    self.pending = set()
+    self.registered_groups = 0
+    self.average_result = None
+
+  def get_state(self):
+    return snapshot({"tot": self.tot, "tot_n": self.tot_n, "contributions": self.contributions,
+            "pending": self.pending, "registered_groups": self.registered_groups,
+            "chains": self.chains, "positions": self.positions, "leaving": self.leaving, "joining": self.joining,
+            "chains_length": self.chains_length, "hop_time": self.hop_time, "leases": self.leases})
+
+  def set_state(self, state):
+    self.__dict__.update(state)
+    self.average_result = None
+
+  def contribute_average(self, group, average, posted):
+    # called with the group lock held, lock order is group -> namespace
+    with self.lock:
+      self.pending.discard(group)
+      self.remove_contribution(group)
+      self.contributions[group] = (average, posted)
+      if self.tot is None:
+        self.tot = self.init_tot(average)
+      self.tot = self.add(self.tot, average, posted)
+      self.tot_n += posted
+      self.average_result = None
+      self.waiters.notify(("average",))
+
+  def withdraw_average(self, group):
+    # called with the group lock held when the group starts a new round
+    with self.lock:
+      self.remove_contribution(group)
+      self.pending.add(group)
+      self.average_result = None
+      if len(self.chains) > 0:
+        # groups dropped by a relayout no longer count
+        for g in list(self.contributions.keys()):
+          if not g in self.chains:
+            self.remove_contribution(g)
+
+  def remove_contribution(self, group):
+    if group not in self.contributions:
+      return
+    (average, posted) = self.contributions.pop(group)
+    if len(self.contributions) == 0:
+      # start the next sum from zero, without the rounding left by withdrawals
+      self.tot = None
+      self.tot_n = 0
+      return
+    self.tot = self.add(self.tot, average, -posted)
+    self.tot_n -= posted
 
   def add(self, v1, v2, f):
     if not isinstance(v1, list):
@@ -181,79 +564,275 @@ class Safe:
     return list(map(lambda x: x/n,tot))
 
   def internal_get_average(self, params):
-    num_groups = len(self.registrations)
-    result = {"status": "empty"}
-    tot = None
-    n = 0
-    num_avgs = 0
-    for k in self.average.keys():
-      if not "average" in self.average[k]:
-        return {"status": "empty"}    
-      if self.average[k]["status"] != "posted":
-        continue
-      if tot is None:
-         tot = self.init_tot(self.average[k]["average"])
-      tot = self.add(tot,self.average[k]["average"],self.group_stats[k]["posted"])
-      n += self.group_stats[k]["posted"]
-      num_avgs += 1
-    if num_avgs >= num_groups:
-      result = {"status": "ok"}
-      result["average"] = self.divide(tot,n)
-    return result
+    if not self.average_result is None:
+      return self.average_result
+    if len(self.pending) > 0 or len(self.contributions) == 0:
+      return {"status": "empty"}
+    if len(self.contributions) < self.registered_groups:
+      return {"status": "empty"}
+    self.average_result = Prebuilt({"status": "ok", "average": self.divide(self.tot,self.tot_n)})
+    return self.average_result
 
   def get_average(self, node=None):
     if not node is None:
       self.debug("get_average: %s" % node)
-    result = self.poll_internal(self.internal_get_average, {"node": node})
+    result = self.poll_internal(self.waiters, self.internal_get_average, {"node": node}, ("average",))
     return result
 
-  def check_progress(self):
-    with self.lock:
-      current_time = time.time()
-      progress = []
-      reposts = []
-      for g in self.aggregate.keys():
-       for n in self.aggregate[g].keys():
-          elapsed = current_time - self.aggregate[g][n]["time"]  
-          progress.append({"group": g, "node": n, "elapsed": elapsed}) 
-          if elapsed > self.config["progress_timeout"]:
-              reposts.append({"failed": n,"group":g,"node": self.aggregate[g][n]["from_node"], "repost": {"status": "repost", "repost_to": n+1}})
-
-      for repost in reposts:
-        if repost["group"] not in self.repost_aggregate:
-          self.repost_aggregate[repost["group"]] = {}
-        self.repost_aggregate[repost["group"]][repost["failed"]] = repost["repost"]
-        del self.aggregate[repost["group"]][repost["failed"]]
-        self.group_stats[repost["group"]]["skipped"] += 1
-      return {"progress":progress,"stats": self.group_stats}
-
-  def register(self, pub_key, group=1):
+  async def aget_average(self, node=None):
+    if not node is None:
+      self.debug("get_average: %s" % node)
+    return await self.apoll_internal(self.waiters, self.internal_get_average, {"node": node}, ("average",))
+
+  def skip(self, state, failed):
+    # caller holds state.lock
+    self.debug("Skipping node %s in group %s" % (failed, state.group))
+    state.repost_aggregate[failed] = {"status": "repost", "repost_to": self.repost_target(state, failed)}
+    state.failed.add(failed)
+    pending = state.aggregate.pop(failed, None)
+    if not pending is None:
+      if "timer" in pending:
+        pending["timer"].cancel()
+      sender = pending.get("from_node")
+      if sender in state.aggregate:
+        # a streaming sender was held up by the full queue into failed, it gets a whole deadline to repost
+        self.arm(state, sender)
+    forwarding = state.forwarding.pop(failed, None)
+    if not forwarding is None and "timer" in forwarding:
+      forwarding["timer"].cancel()
+    state.stats["skipped"] += 1
+    state.waiters.notify(("check", failed))
+    state.waiters.notify(("space", failed))
+
+  def expire(self, state, node, posted_time):
+    """Fired by the progress scheduler when an aggregate posted to node
+    has not been consumed within its deadline.
+    """
+    with state.lock:
+      if node in state.aggregate and state.aggregate[node]["time"] == posted_time:
+        self.skip(state, node)
+
+  def expire_forward(self, state, node, consumed_time):
+    """Fired by the progress scheduler when node consumed an aggregate or
+    chunk and did not forward it within its deadline. Its predecessor
+    still holds what it posted and reposts past node.
+    """
+    with state.lock:
+      if node in state.forwarding and state.forwarding[node]["time"] == consumed_time:
+        self.skip(state, node)
+
+  def init_layout(self):
+    # chains laid out by the controller, guarded by self.lock
+    self.chains = {}
+    self.positions = {}
+    self.leaving = set()
+    # nodes that registered mid-round, laid out when the round is over
+    self.joining = []
+    self.chains_length = 0
+    self.hop_time = None
+    # lease expiry of the registrations that asked for one, others never lapse
+    self.leases = {}
+
+  def laid_out(self):
+    return self.config["chain_length"] > 0 or self.config["chain_latency_budget"] > 0
+
+  def target_chain_length(self):
+    """Longest chain wanted, from CHAIN_LENGTH and the hops that fit in
+    the latency budget at the smoothed hop time, 0 if unbounded.
+    """
+    target = self.config["chain_length"]
+    if self.config["chain_latency_budget"] > 0 and not self.hop_time is None:
+      budget_length = max(2, int(self.config["chain_latency_budget"] / max(self.hop_time, 1e-3)))
+      if target == 0 or budget_length < target:
+        target = budget_length
+    return target
+
+  def relayout(self):
+    """Drops the nodes that left or whose lease lapsed and balances the chains, so that they
+    stay within the target chain length and differ by at most one node,
+    with at least two nodes per chain so no group average is a single
+    node's value. The latter wins for a target of two and an odd number
+    of nodes, where one chain has three, and for a target of one, which
+    lays out chains of two. Nodes keep their chain unless it has to
+    shrink, so a relayout moves few nodes. Caller holds self.lock.
+    """
+    leaving = self.leaving | set(self.lapsed())
+    chains = []
+    for g in sorted(self.chains.keys()):
+      chains.append([pub_key for pub_key in self.chains[g] if not pub_key in leaving])
+    self.leaving = set()
+    target = self.target_chain_length()
+    groups = self.layout_groups(sum(len(chain) for chain in chains), target)
+    while len(chains) > groups:
+      for pub_key in chains.pop():
+        min(chains, key=len).append(pub_key)
+    while len(chains) < groups:
+      chains.append([])
+    while len(max(chains, key=len)) - len(min(chains, key=len)) > 1:
+      min(chains, key=len).append(max(chains, key=len).pop())
+    self.chains = {}
+    self.positions = {}
+    for (g, chain) in enumerate(chains):
+      self.chains[g + 1] = chain
+      for (i, pub_key) in enumerate(chain):
+        self.positions[pub_key] = (g + 1, i + 1)
+    self.chains_length = target
+    self.registered_groups = groups
+
+  def layout_groups(self, n, target):
+    # number of chains for n nodes, none longer than target unless that leaves a chain of one
+    if target <= 0:
+      return 1
+    return max(1, min(-(-n // target), n // 2))
+
+  def relayout_due(self):
+    """Whether the chains need moves or a new group count. Caller holds self.lock."""
+    if len(self.leaving) > 0 or len(self.lapsed()) > 0 or self.target_chain_length() != self.chains_length:
+      return True
+    sizes = [len(chain) for chain in self.chains.values()]
+    if len(sizes) == 0:
+      return False
+    return max(sizes) - min(sizes) > 1 or len(sizes) != self.layout_groups(sum(sizes), self.chains_length)
+
+  def live(self, pub_key, current_time):
+    # caller holds self.lock
+    return not pub_key in self.leases or self.leases[pub_key] > current_time
+
+  def lapsed(self):
+    """Laid out nodes whose lease ran out. Caller holds self.lock."""
+    current_time = time.time()
+    return [pub_key for pub_key in self.positions if not self.live(pub_key, current_time)]
+
+  def register(self, pub_key, group=1, layout=False, lease=False):
+    if lease and self.config["lease_time"] > 0:
+      # registering grants a lease that heartbeats renew
+      with self.lock:
+        self.leases[pub_key] = time.time() + self.config["lease_time"]
+      result = dict(self.join(pub_key, group, layout))
+      result["lease"] = self.config["lease_time"]
+      return result
+    return self.join(pub_key, group, layout)
+
+  def heartbeat(self, pub_keys):
+    """Renews the leases of pub_keys, sent in one batch for all the
+    aggregators of a client process.
+    """
     with self.lock:
+      expiry = time.time() + self.config["lease_time"]
+      for pub_key in pub_keys:
+        if pub_key in self.leases:
+          self.leases[pub_key] = expiry
+    return {"status": "ok", "lease": self.config["lease_time"]}
+
+  def join(self, pub_key, group, layout):
+    if layout and self.laid_out():
+      # clients register again at round start to pick up relayouts
+      with self.lock:
+        self.leaving.discard(pub_key)
+        if not pub_key in self.positions and not pub_key in self.joining:
+          self.joining.append(pub_key)
+        if len(self.pending) == 0:
+          # joins, moves and group count changes only happen between rounds
+          self.place_joining()
+          if self.relayout_due():
+            self.relayout()
+        if pub_key in self.positions:
+          (group, index) = self.positions[pub_key]
+        else:
+          (group, index) = self.provisional_position(pub_key)
+      return {"index": index, "group": group}
+    state = self.get_group(group)
+    with state.lock:
       self.debug("Pub Key: %s" % pub_key)
-      if group not in self.registrations:
-        self.registrations[group] = {}
-      if pub_key in self.registrations[group]:
-        return self.registrations[group][pub_key]
-      current_index = len(self.registrations[group]) + 1
-      self.registrations[group][pub_key] = {"index": current_index}
-      return self.registrations[group][pub_key]
+      if pub_key in state.registrations:
+        return state.registrations[pub_key]
+      current_index = len(state.registrations) + 1
+      state.registrations[pub_key] = {"index": current_index}
+      if current_index == 1:
+        with self.lock:
+          self.registered_groups += 1
+          self.average_result = None
+      return state.registrations[pub_key]
+
+  def place_joining(self):
+    """Appends the nodes that joined mid-round to the shortest chains.
+    Caller holds self.lock.
+    """
+    for pub_key in self.joining:
+      if len(self.chains) == 0:
+        self.chains[1] = []
+      (group, chain) = min(self.chains.items(), key=lambda item: len(item[1]))
+      chain.append(pub_key)
+      self.positions[pub_key] = (group, len(chain))
+    self.joining = []
+
+  def provisional_position(self, pub_key):
+    """Position a node that joined mid-round is expected to take once the
+    round is over. It is not published to the running chains, and the
+    node picks up its actual position when it registers again at the
+    start of its next round. Caller holds self.lock.
+    """
+    sizes = {group: len(chain) for (group, chain) in self.chains.items()}
+    if len(sizes) == 0:
+      sizes[1] = 0
+    for joiner in self.joining:
+      group = min(sizes, key=lambda g: sizes[g])
+      sizes[group] += 1
+      if joiner == pub_key:
+        return (group, sizes[group])
+
+  def unregister(self, pub_key):
+    """Removes a node laid out by the controller, or ends the lease of a
+    node so it is left out of the published registrations. The chains
+    are rebalanced between rounds so running chains keep their members.
+    """
+    with self.lock:
+      if not pub_key in self.positions and not pub_key in self.leases and not pub_key in self.joining:
+        return {"status": "empty"}
+      if pub_key in self.joining:
+        self.joining.remove(pub_key)
+      if pub_key in self.leases:
+        self.leases[pub_key] = 0
+      if pub_key in self.positions:
+        self.leaving.add(pub_key)
+        if len(self.pending) == 0:
+          self.relayout()
+    return {"status": "ok"}
 
   def get_registrations(self, group=1):
+    self.debug("Group: %s" % group)
+    # only live nodes are published, so the chain of a round skips lapsed ones
+    current_time = time.time()
     with self.lock:
-      self.debug("Group: %s" % group)
-      registration_map = {}
-      if group not in self.registrations:
+      if len(self.positions) > 0:
+        registration_map = {}
+        for (pub_key, (chain, index)) in self.positions.items():
+          if chain == group and self.live(pub_key, current_time):
+            registration_map[index] = {"pub_key": pub_key}
         return registration_map
-      for key in self.registrations[group].keys():
-        registration_map[self.registrations[group][key]["index"]] = {"pub_key": key}
+    state = self.get_group(group)
+    with state.lock:
+      registration_map = {}
+      with self.lock:
+        for key in state.registrations.keys():
+          if self.live(key, current_time):
+            registration_map[state.registrations[key]["index"]] = {"pub_key": key}
       return registration_map
 
   def clear_data(self):
     with self.lock:
-      self.nodes = {}
-      self.aggregate = {}
-      self.repost_aggregate = {}
-      self.average = {}
-      self.group_stats = {}
-      self.registrations = {}
-      return {"status":"OK"}
+      groups = self.groups
+      self.groups = {}
+      self.init_totals()
+      self.init_layout()
+      self.waiters.notify_all()
+    for state in groups.values():
+      with state.lock:
+        state.cancel_timers()
+        state.waiters.notify_all()
+    self.store.remove(self.key)
+    return {"status":"OK"}
+
+  def close(self):
+    """Tears down the namespace, cancelling its pending progress timers."""
+    self.clear_data()
@@ -0,0 +1,50 @@
+#! /usr/bin/env python3
+from werkzeug.security import check_password_hash
+import json
+import os
+
+# Namespace registry and credentials shared by the Flask and asyncio controllers.
+
+ns = {}
+
+namespace_auth_db = {}
+filename = '/config/namespaces.json'
+if os.path.exists(filename):
+  with open(filename) as f:
+    namespace_auth_db = json.loads(f.read())
+
+auth_enabled_env = os.getenv("AUTH_ENABLED")
+auth_enabled = False
+if not auth_enabled_env is None and auth_enabled_env == "yes":
+  auth_enabled = True
+
+def check_password(namespace, password):
+  return namespace in namespace_auth_db and \
+            check_password_hash(namespace_auth_db.get(namespace), password)
+
+def get_instance_namespace(namespace, algo, constructor):
+  global ns
+  if namespace not in ns:
+    ns[namespace] = {}
+  if algo not in ns[namespace]:
+    ns[namespace][algo] = constructor(namespace)
+  return ns[namespace][algo]
+
+def remove_namespace(namespace):
+  global ns
+  if namespace not in ns:
+    return
+  instances = ns.pop(namespace)
+  for instance in instances.values():
+    if hasattr(instance, "close"):
+      instance.close()
+
+def get_ns(data):
+  if "namespace" in data:
+    return data["namespace"]
+  return "global"
+
+def get_group(data):
+  if "group" in data:
+    return data["group"]
+  return 1
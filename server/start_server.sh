@@ -2,5 +2,13 @@
 touch controller.log
 touch controller.debug
 CONTROLLER_PORT=${CONTROLLER_PORT:-8088}
-python3 -u controller.py ${CONTROLLER_PORT} 2>&1 >controller.log &
+CONTROLLER_MODE=${CONTROLLER_MODE:-threaded}
+CONTROLLER_WORKERS=${CONTROLLER_WORKERS:-1}
+if [ "${CONTROLLER_MODE}" == "async" ]; then
+  for i in $(seq 1 ${CONTROLLER_WORKERS}); do
+    python3 -u async_controller.py ${CONTROLLER_PORT} 2>&1 >>controller.log &
+  done
+else
+  python3 -u controller.py ${CONTROLLER_PORT} 2>&1 >controller.log &
+fi
 tail -f controller.log -f controller.debug
@@ -0,0 +1,229 @@
+#! /usr/bin/env python3
+import fcntl
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+
+# State stores behind the locks of Safe, SafeGroup, Bon and InSec. Every
+# change to protocol state is made under one of those locks, so a store only
+# decides what a lock is:
+#
+#   memory  plain in-process locks, state lives in the objects (default)
+#   sqlite  each lock is a lock on a record of a shared SQLite file, so
+#           several controller processes can serve the same namespaces
+#
+# Owners of a record lock implement get_state() and set_state(state) over
+# their persistent fields. Each group of a namespace is a record with a lock
+# of its own, and a group lock is taken before the lock of its namespace.
+
+store = None
+store_lock = threading.Lock()
+
+
+def snapshot(value):
+  """Copies nested dicts, turning memoryviews into bytes so they pickle."""
+  if isinstance(value, dict):
+    return {key: snapshot(item) for (key, item) in value.items()}
+  if isinstance(value, memoryview):
+    return value.tobytes()
+  return value
+
+
+class MemoryStore:
+  poll_interval = None
+
+  def lock(self, owner, key):
+    return threading.RLock()
+
+  def remove(self, prefix):
+    pass
+
+
+class RecordLock:
+  """Lock on the record key, held by one thread of one process at a time.
+
+  Threads of this process take the in-process mutex of the record, and
+  processes take a file lock of the record. Acquiring it loads the record
+  into its owner if another process changed it since this process last saw
+  it, and releasing it writes the owner's state back if it changed. A read
+  acquire takes a shared file lock and never writes, so its release skips
+  pickling the state. Reads and writes are single statements, so SQLite
+  only orders those of different records and never holds its write lock
+  over a critical section. Waiters in other processes are not notified,
+  they compare the record version every poll_interval.
+  """
+  def __init__(self, store, owner, key):
+    self.store = store
+    self.owner = owner
+    self.key = key
+    self.mutex = store.mutex(key)
+    self.initial = pickle.dumps(owner.get_state())
+    self.version = None
+    self.data = self.initial
+    self.write = True
+    self.file = None
+    self.depth = 0
+
+  def acquire(self, blocking=True, timeout=-1, write=True):
+    if not self.mutex.acquire(blocking, timeout):
+      return False
+    if self.depth > 0:
+      # nested in this thread, the outer acquire holds the record
+      self.depth += 1
+      return True
+    try:
+      self.file = self.store.lock_record(self.key, write)
+      try:
+        (version, data) = self.store.read(self.key)
+        if version != self.version:
+          if data is None:
+            data = self.initial
+          self.owner.set_state(pickle.loads(data))
+          self.version = version
+          self.data = data
+      except Exception:
+        self.store.unlock_record(self.file)
+        raise
+    except Exception:
+      self.mutex.release()
+      raise
+    self.write = write
+    self.depth = 1
+    return True
+
+  def release(self):
+    self.depth -= 1
+    if self.depth > 0:
+      self.mutex.release()
+      return
+    try:
+      if self.write:
+        data = pickle.dumps(self.owner.get_state())
+        if data != self.data:
+          self.version = self.store.write(self.key, data)
+          self.data = data
+    finally:
+      try:
+        self.store.unlock_record(self.file)
+      finally:
+        self.file = None
+        self.mutex.release()
+
+  def discard(self):
+    # the owner changed its state under a read acquire, the next acquire loads the record again
+    self.version = None
+
+  def changed(self, version):
+    # whether the record moved on from version, read without taking the record lock
+    return self.store.version(self.key) != version
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, *args):
+    self.release()
+
+
+class SqliteStore:
+  """Records in one SQLite file shared by the controller processes of a
+  host. Each record has an in-process mutex and a lock file next to the
+  SQLite file, so records are locked independently of each other.
+  """
+  def __init__(self, path, poll_interval=0.05):
+    self.path = path
+    self.poll_interval = poll_interval
+    self.locks_path = path + ".locks"
+    os.makedirs(self.locks_path, exist_ok=True)
+    self.mutexes = {}
+    self.mutexes_lock = threading.Lock()
+    self.local = threading.local()
+    self.connection().execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, version INTEGER NOT NULL, data BLOB NOT NULL)")
+
+  def connection(self):
+    if not hasattr(self.local, "db"):
+      self.local.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+      self.local.db.execute("PRAGMA journal_mode=WAL")
+    return self.local.db
+
+  def lock(self, owner, key):
+    return RecordLock(self, owner, key)
+
+  def mutex(self, key):
+    with self.mutexes_lock:
+      if not key in self.mutexes:
+        self.mutexes[key] = threading.RLock()
+      return self.mutexes[key]
+
+  def lock_record(self, key, write=True):
+    # flock locks belong to the open file, so each holder opens its own
+    name = hashlib.sha1(key.encode()).hexdigest()
+    fd = os.open(os.path.join(self.locks_path, name), os.O_RDWR | os.O_CREAT)
+    try:
+      if write:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+      else:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+    except Exception:
+      os.close(fd)
+      raise
+    return fd
+
+  def unlock_record(self, fd):
+    # closing the file drops its lock
+    os.close(fd)
+
+  def read(self, key):
+    row = self.connection().execute("SELECT version, data FROM state WHERE key = ?", (key,)).fetchone()
+    if row is None:
+      return (None, None)
+    return row
+
+  def version(self, key):
+    row = self.connection().execute("SELECT version FROM state WHERE key = ?", (key,)).fetchone()
+    if row is None:
+      return None
+    return row[0]
+
+  def write(self, key, data):
+    # random versions, so a record removed and written again never looks unchanged
+    version = int.from_bytes(os.urandom(8), "little") >> 1
+    self.connection().execute("INSERT OR REPLACE INTO state (key, version, data) VALUES (?, ?, ?)", (key, version, data))
+    return version
+
+  def remove(self, prefix):
+    """Removes the record prefix and the records below it, each under its
+    lock. The caller holds none of their locks.
+    """
+    rows = self.connection().execute("SELECT key FROM state WHERE key = ? OR substr(key, 1, ?) = ?", (prefix, len(prefix) + 1, prefix + "/")).fetchall()
+    for (key,) in rows:
+      with self.mutex(key):
+        fd = self.lock_record(key)
+        try:
+          self.connection().execute("DELETE FROM state WHERE key = ?", (key,))
+        finally:
+          self.unlock_record(fd)
+
+
+def get_store():
+  global store
+  with store_lock:
+    if store is None:
+      state_store_env = os.getenv("STATE_STORE")
+      if state_store_env is None or state_store_env == "":
+        state_store_env = "memory"
+      state_store_path_env = os.getenv("STATE_STORE_PATH")
+      if state_store_path_env is None or state_store_path_env == "":
+        state_store_path_env = "state.db"
+      store_poll_interval_env = os.getenv("STORE_POLL_INTERVAL")
+      if store_poll_interval_env is None or store_poll_interval_env == "":
+        store_poll_interval = 0.05
+      else:
+        store_poll_interval = float(store_poll_interval_env)
+      if state_store_env == "sqlite":
+        store = SqliteStore(state_store_path_env, store_poll_interval)
+      else:
+        store = MemoryStore()
+    return store
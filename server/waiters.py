@@ -0,0 +1,157 @@
+#! /usr/bin/env python3
+import asyncio
+import time
+import threading
+
+
+def is_empty(result):
+  return ("status" in result) and (result["status"] == "empty")
+
+
+def wake(future):
+  if not future.done():
+    future.set_result(True)
+
+
+class Waiters:
+  """Long-poll waiters parked on keys such as ("aggregate", node).
+
+  All conditions share the lock of the state they guard, so a writer that
+  changes the state under that lock calls notify() for the affected key and
+  only the waiters on that key wake up. Idle waiters block and use no CPU.
+  Coroutines of the asyncio controller park futures on the same keys.
+  With a shared state store writers in other processes cannot notify, so
+  waiters also wake every interval and compare the record version. Only a
+  changed record is re-checked, under a read lock, and the write lock
+  is taken again once the check has a result. The asyncio controller runs
+  the store I/O in its executor, off the event loop.
+  """
+  def __init__(self, lock, interval=None):
+    self.lock = lock
+    # conditions wait on the in-process part of a shared store lock
+    self.mutex = getattr(lock, "mutex", lock)
+    self.interval = interval
+    self.conditions = {}
+    self.futures = {}
+    self.futures_lock = threading.Lock()
+
+  def acquire(self, key):
+    if key not in self.conditions:
+      self.conditions[key] = [threading.Condition(self.mutex), 0]
+    self.conditions[key][1] += 1
+    return self.conditions[key][0]
+
+  def release(self, key):
+    self.conditions[key][1] -= 1
+    if self.conditions[key][1] == 0:
+      del self.conditions[key]
+
+  def notify(self, key):
+    # caller must hold self.lock
+    if key in self.conditions:
+      self.conditions[key][0].notify_all()
+    with self.futures_lock:
+      futures = self.futures.pop(key, set())
+    for (loop, future) in futures:
+      loop.call_soon_threadsafe(wake, future)
+
+  def notify_all(self):
+    # caller must hold self.lock
+    for condition in self.conditions.values():
+      condition[0].notify_all()
+    for key in list(self.futures.keys()):
+      self.notify(key)
+
+  def slice(self, remaining):
+    if self.interval is None:
+      return remaining
+    return min(remaining, self.interval)
+
+  def check(self, func, params, write):
+    """Runs func under self.lock. A re-check on a shared store runs it under a
+    read lock first, and again under the write lock only if it has
+    a result.
+    """
+    if not write and not self.interval is None:
+      self.lock.acquire(write=False)
+      try:
+        result = func(params)
+        if is_empty(result):
+          return result
+        # func changed the state without writing it, it is loaded again
+        self.lock.discard()
+      finally:
+        self.lock.release()
+    with self.lock:
+      return func(params)
+
+  def version(self):
+    # version of the record a check saw, caller holds self.mutex
+    if self.interval is None:
+      return None
+    return self.lock.version
+
+  def wait(self, key, deadline, version):
+    """Blocks until key is notified, the record moved on from version or
+    deadline. Caller holds self.mutex.
+    """
+    condition = self.acquire(key)
+    try:
+      while not condition.wait(self.slice(deadline - time.time())):
+        if self.interval is None or time.time() >= deadline or self.lock.changed(version):
+          return
+    finally:
+      self.release(key)
+
+  def poll(self, func, params, key, timeout):
+    deadline = time.time() + timeout
+    write = True
+    with self.mutex:
+      while True:
+        result = self.check(func, params, write)
+        if not is_empty(result) or deadline - time.time() <= 0:
+          return result
+        self.wait(key, deadline, self.version())
+        write = False
+
+  def park(self, func, params, key, waiter, deadline, write):
+    # checks func and parks waiter on key if its result is empty and time is left
+    with self.mutex:
+      result = self.check(func, params, write)
+      if not is_empty(result) or deadline - time.time() <= 0:
+        return (result, False, None)
+      with self.futures_lock:
+        if key not in self.futures:
+          self.futures[key] = set()
+        self.futures[key].add(waiter)
+      return (result, True, self.version())
+
+  async def call(self, loop, func, *args):
+    # a shared store does I/O under its lock, which stays off the event loop
+    if self.interval is None:
+      return func(*args)
+    return await loop.run_in_executor(None, func, *args)
+
+  async def apoll(self, func, params, key, timeout):
+    loop = asyncio.get_running_loop()
+    deadline = time.time() + timeout
+    write = True
+    while True:
+      future = loop.create_future()
+      (result, parked, version) = await self.call(loop, self.park, func, params, key, (loop, future), deadline, write)
+      if not parked:
+        return result
+      try:
+        while True:
+          (done, pending) = await asyncio.wait({future}, timeout=self.slice(deadline - time.time()))
+          if len(done) > 0 or self.interval is None or time.time() >= deadline:
+            break
+          if await self.call(loop, self.lock.changed, version):
+            break
+      finally:
+        with self.futures_lock:
+          if key in self.futures:
+            self.futures[key].discard((loop, future))
+            if len(self.futures[key]) == 0:
+              del self.futures[key]
+      write = False
@@ -1,4 +1,5 @@
+from aiohttp import web
 from proxy import app
 
 if __name__ == "__main__":
-  app.run(host="0.0.0.0", port=8088, debug=True, threaded=False)
+  web.run_app(app, host="0.0.0.0", port=8088)
@@ -2,24 +2,37 @@
 cd /server
 touch controller.log
 touch controller.debug
-python3 -u controller.py 8088 2>&1 >controller.log &
-PID=$!
 
 cd /tests
-./wait-for-it.sh -h localhost -p 8088
 echo "Starting tests"
 SYSEXIT=0
 while IFS= read -r line
 do
   echo "$line"
+  # upper case KEY=VALUE arguments configure the controller of this test
+  ENV=()
+  CONTROLLER=controller.py
+  for arg in $line; do
+    if [[ "$arg" =~ ^[A-Z_]+= ]]; then
+      ENV+=("$arg")
+      if [ "$arg" == "CONTROLLER_MODE=async" ]; then
+        CONTROLLER=async_controller.py
+      fi
+    fi
+  done
+  cd /server
+  env "${ENV[@]}" python3 -u $CONTROLLER 8088 >>controller.log 2>&1 &
+  PID=$!
+  cd /tests
+  ./wait-for-it.sh -h localhost -p 8088
   python3 -u test.py $line | tee -a test.log
-  if [ $? -ne 0 ]; then
+  if [ ${PIPESTATUS[0]} -ne 0 ]; then
     SYSEXIT=1
   fi
+  kill $PID
+  wait $PID
 done < tests.conf
 
-kill $PID
-
 cat /server/controller.log /server/controller.debug
 cat test.log
 
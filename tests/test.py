@@ -1,8 +1,10 @@
 #! /usr/bin/env python3
+import aggregation
 from aggregation import SecureAggregation
 import sys
 import os
 import json
+import time
 from threading import Thread
 import requests
 
@@ -14,29 +16,64 @@ class AggregationThread(Thread):
   def run(self):
     self.result = self.aggregator.aggregate(self.val)
 
-aggregation_vector = sys.argv[3:]
-expected = float(sys.argv[2])
+def parse_value(value):
+  # comma separated values are aggregated as vectors
+  if "," in value:
+    return [float(x) for x in value.split(",")]
+  return float(value)
+
 aggregation_type = sys.argv[1]
+expected = parse_value(sys.argv[2])
 
 with open('/config/config.json') as f:
    options = json.loads(f.read())
 options["controller"] = "http://localhost:8088"
 options["ag_type"] = aggregation_type
 
+# lower case key=value arguments are client options, upper case ones
+# configure the controller in start_tests.sh
+aggregation_vector = []
+dead = 0
+for arg in sys.argv[3:]:
+  if not "=" in arg:
+    aggregation_vector.append(arg)
+    continue
+  (key, value) = arg.split("=", 1)
+  if key == "dead":
+    dead = int(value)
+  elif key.islower():
+    options[key] = json.loads(value)
+
 threads = []
 for v in aggregation_vector:
  secure_aggregator = SecureAggregation(options)
  secure_aggregator.register()
  print(f"INDEX {secure_aggregator.index}")
- threads.append(AggregationThread(secure_aggregator,float(v)))
+ threads.append(AggregationThread(secure_aggregator,parse_value(v)))
+
+# dead nodes register after the live ones and never aggregate
+lease = 0
+for i in range(dead):
+  dead_aggregator = SecureAggregation(options)
+  dead_aggregator.register()
+  print(f"DEAD INDEX {dead_aggregator.index}")
+  if dead_aggregator.lease > 0:
+    aggregation.get_heartbeats().remove(dead_aggregator)
+    lease = dead_aggregator.lease
+if lease > 0:
+  # let the leases of the dead nodes lapse
+  time.sleep(lease + 1)
 
 sysexit = 0
 for t in threads:
    t.start()
 for t in threads:
    t.join()
-   print(f"RESULT {t.result} EXPECTED {expected}")
-   if t.result != expected:
+   result = t.result
+   if isinstance(expected, list):
+     result = [float(x) for x in result]
+   print(f"RESULT {result} EXPECTED {expected}")
+   if result != expected:
      sysexit = 1
 
 requests.post("http://localhost:8088/clear_data", json={})